@@ -0,0 +1,218 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+from qc_simulator import QuantumComputer
+from interperter import QuantumInterpreter
+from qubit import Qubit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GATES = ["new_qubit", "hadamard", "toggle", "CNOT", "CCNOT", "rotate", "extract"]
+QCODE_PROGRAMS = ["grover.qcode", "bias_busting.qcode", "mystery_toggles.qcode"]
+# run as scripts from this directory, which has the CCode files they load
+SCRIPT_PROGRAMS = [os.path.join(HERE, "..", "python_library", "grovers.py")]
+# timings below this are mostly noise and never count as regressions
+NOISE_FLOOR = 1e-3
+
+def best_time(func, repeat, setup=None):
+    """
+    Smallest wall time of repeat calls of func, setup (untimed) running before each
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def peak_memory(func, setup=None):
+    """
+    Bytes allocated at the peak of one call of func, above what was allocated before it.
+    numpy reports its buffers to tracemalloc, so preallocated state buffers count 0
+    """
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    func()
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return peak
+
+def result(kind, name, qubits, wall_time, memory, amplitudes):
+    return {"kind": kind, "name": name, "qubits": qubits, "wall_time": wall_time, "peak_memory": memory,
+            "amplitudes_per_sec": None if amplitudes is None else amplitudes / max(wall_time, 1e-9)}
+
+# Gates
+def gate_benchmarks(n, repeat, dtype, threads):
+    """
+    Time each gate on a uniform superposition of n qubits (new_qubit grows n - 1
+    qubits to n, extract shrinks n to n - 1)
+    """
+    qc = QuantumComputer(dtype, threads, seed=0)
+    qubits = [Qubit(f"q{i}") for i in range(n)]
+    qc.new_qubit(*qubits)
+    qc.hadamard()
+    last = qubits[-1]
+
+    def add_last():
+        qc.new_qubit(last)
+        qc.materialize([last])
+
+    def restore_last():
+        # back to n qubits, all of them in superposition
+        if last not in qc.qubits:
+            add_last()
+            qc.hadamard(last)
+
+    def drop_last():
+        if last in qc.qubits:
+            qc.extract(last)
+
+    gates = {
+        "new_qubit": (add_last, drop_last),
+        "hadamard": (lambda: qc.hadamard(qubits[0]), restore_last),
+        "toggle": (lambda: qc.toggle(qubits[0]), restore_last),
+        "CNOT": (lambda: qc.CNOT(qubits[0], qubits[1]), restore_last),
+        "CCNOT": (lambda: qc.CCNOT(qubits[0], qubits[1], qubits[2]), restore_last),
+        "rotate": (lambda: qc.rotate(qubits[0], 30), restore_last),
+        "extract": (lambda: qc.extract(last), restore_last),
+    }
+    results = []
+    for name in GATES:
+        if name == "CCNOT" and n < 3:
+            continue
+        func, setup = gates[name]
+        wall_time = best_time(func, repeat, setup)
+        memory = peak_memory(func, setup)
+        results.append(result("gate", name, n, wall_time, memory, 2**n))
+    return results
+
+# Programs
+def qcode_benchmark(file_name, repeat, dtype):
+    """
+    Run a .qcode program end to end with the default (auto) backend. Its amplitudes are
+    2^(qubits in the state vector) summed over the executed instructions, leaving out the
+    lazily allocated qubits that are still known bits
+    """
+    def run(interpreter):
+        interpreter.parse(file_name)
+        interpreter.run()
+
+    wall_time = best_time(lambda: run(QuantumInterpreter(dtype=dtype, seed=0, verbose=False)), repeat)
+
+    # one more run, traced, counting the amplitudes and the largest register
+    interpreter = QuantumInterpreter(dtype=dtype, seed=0, verbose=False)
+    counts = {"amplitudes": 0, "qubits": 0}
+    def counted(handler):
+        def wrapper(*args):
+            qc = interpreter.qc
+            # the stabilizer tableau has no layout, all its qubits count
+            counts["amplitudes"] += 2**len(getattr(qc, "layout", qc.qubits))
+            counts["qubits"] = max(counts["qubits"], len(qc.qubits))
+            handler(*args)
+        return wrapper
+    interpreter.handlers = {op: counted(handler) for op, handler in interpreter.handlers.items()}
+    memory = peak_memory(lambda: run(interpreter))
+    return result("program", file_name, counts["qubits"], wall_time, memory, counts["amplitudes"])
+
+def script_benchmark(path, repeat):
+    """
+    Run a Python script in a new process. Its peak memory is the process' maximum
+    resident set size, and its amplitudes are not counted
+    """
+    best, memory = float("inf"), 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, path], cwd=HERE, stdout=subprocess.DEVNULL)
+        _, status, usage = os.wait4(process.pid, 0)
+        best = min(best, time.perf_counter() - start)
+        assert status == 0, f"{path} failed"
+        memory = max(memory, usage.ru_maxrss * 1024) # kilobytes on Linux
+    return result("program", os.path.basename(path), None, best, memory, None)
+
+# Baselines
+def regressions(results, baseline, tolerance):
+    """
+    Entries of results slower than the matching baseline entry by more than tolerance
+    (a fraction of the baseline time), as (entry, baseline time)
+    """
+    key = lambda entry: (entry["kind"], entry["name"], entry["qubits"])
+    old = {key(entry): entry["wall_time"] for entry in baseline["results"]}
+    slower = []
+    for entry in results:
+        base = old.get(key(entry))
+        if base is not None and entry["wall_time"] > max(base * (1 + tolerance), base + NOISE_FLOOR):
+            slower.append((entry, base))
+    return slower
+
+def run_benchmarks(min_qubits=2, max_qubits=26, repeat=3, dtype=np.complex128, threads=None, programs=True,
+                   log=None):
+    """
+    Time the gates for every n in min_qubits..max_qubits and the bundled programs.
+    Returns a JSON-able dict whose results are one entry per gate and n or program
+    - log: called with each entry as it is measured
+    """
+    results = []
+    def add(entries):
+        for entry in entries:
+            results.append(entry)
+            if log is not None:
+                log(entry)
+
+    for n in range(min_qubits, max_qubits + 1):
+        add(gate_benchmarks(n, repeat, dtype, threads))
+    if programs:
+        cwd = os.getcwd()
+        os.chdir(HERE) # programs load their imports relative to the working directory
+        try:
+            for file_name in QCODE_PROGRAMS:
+                add([qcode_benchmark(file_name, repeat, dtype)])
+            for path in SCRIPT_PROGRAMS:
+                add([script_benchmark(path, repeat)])
+        finally:
+            os.chdir(cwd)
+    return {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+            "dtype": np.dtype(dtype).name, "threads": threads, "repeat": repeat, "results": results}
+
+def describe(entry):
+    qubits = "" if entry["qubits"] is None else f" n={entry['qubits']}"
+    rate = "" if entry["amplitudes_per_sec"] is None else f", {entry['amplitudes_per_sec']:.3g} amplitudes/s"
+    return (f"{entry['kind']} {entry['name']}{qubits}: {entry['wall_time'] * 1e3:.3f} ms, "
+            f"{entry['peak_memory'] / 2**20:.1f} MiB{rate}")
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Time the simulator's gates and the bundled programs")
+    parser.add_argument("--min-qubits", type=int, default=2)
+    parser.add_argument("--max-qubits", type=int, default=26)
+    parser.add_argument("--repeat", type=int, default=3, help="keep the best of this many runs of each benchmark")
+    parser.add_argument("--dtype", choices=["complex128", "complex64", "float32"], default="complex128")
+    parser.add_argument("--threads", type=int, default=None, help="run gates on this many threads")
+    parser.add_argument("--no-programs", action="store_true", help="only time the gates")
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file, e.g. a new baseline")
+    parser.add_argument("--baseline", default=None, help="JSON file of an earlier run to compare the times against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="report entries this fraction slower than the baseline as regressions")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.min_qubits, args.max_qubits, args.repeat, args.dtype, args.threads,
+                            not args.no_programs, log=lambda entry: print(describe(entry), flush=True))
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            slower = regressions(report["results"], json.load(file), args.tolerance)
+        for entry, base in slower:
+            print(f"Regression: {describe(entry)} (baseline {base * 1e3:.3f} ms)")
+        if len(slower) > 0:
+            sys.exit(1)
+        print("No regressions")
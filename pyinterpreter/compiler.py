@@ -0,0 +1,171 @@
+import ast
+import math
+import operator
+from collections import namedtuple
+
+# Opcodes
+NEW = "new"             # (slots, names)
+EXTRACT = "extract"     # (slots or None for all, label)
+SHOTS = "shots"         # (shots,)
+CALL = "call"           # (qcode name, argument slots)
+PRINT = "print"         # ()
+REPEAT = "repeat"       # (count, index of the matching END)
+END = "end"             # (index of the matching REPEAT,)
+HADAMARD = "hadamard"   # (slots or None for all,)
+TOGGLE = "toggle"       # (slot,)
+CNOT = "cnot"           # (A, B)
+NOT_CNOT = "not_cnot"   # (A, B)
+CCNOT = "ccnot"         # (A, B, C)
+OR_CNOT = "or_cnot"     # (A, B, C)
+MINUS = "minus"         # (slots,): -1 where all of them are 1
+F_MINUS = "f_minus"     # (ccode name, argument slots)
+F_TOGGLE = "f_toggle"   # (ccode name, argument slots, target slots)
+PERP = "perp"           # (qcode name, argument slots)
+
+Instruction = namedtuple("Instruction", ["op", "args", "line"])
+
+# what a repeat count may use besides numbers and n, the number of qubits in the frame
+COUNT_NAMES = {"pi": math.pi}
+COUNT_FUNCTIONS = {"sqrt": math.sqrt, "log2": math.log2, "floor": math.floor, "ceil": math.ceil, "round": round}
+COUNT_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+                   ast.Div: operator.truediv, ast.Pow: operator.pow, ast.UAdd: operator.pos, ast.USub: operator.neg}
+
+class ParseError(Exception):
+    pass
+
+def parse_count(text):
+    """
+    A repeat count: an int, or the syntax tree of an expression of n checked to only
+    hold numbers, names of COUNT_NAMES, the operators of COUNT_OPERATORS and calls of
+    COUNT_FUNCTIONS. Raises ParseError for anything else
+    """
+    if text.isdigit():
+        return int(text)
+    try:
+        tree = ast.parse(text.replace("^", "**"), mode="eval").body
+    except SyntaxError:
+        raise ParseError(f"bad repeat count: {text}")
+    called = [node.func for node in ast.walk(tree) if isinstance(node, ast.Call)]
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant):
+            allowed = type(node.value) in (int, float)
+        elif isinstance(node, ast.Name):
+            allowed = node.id == "n" or node.id in COUNT_NAMES or (node in called and node.id in COUNT_FUNCTIONS)
+        elif isinstance(node, ast.Call):
+            allowed = isinstance(node.func, ast.Name) and node.func.id in COUNT_FUNCTIONS and not node.keywords
+        elif isinstance(node, (ast.BinOp, ast.UnaryOp)):
+            allowed = type(node.op) in COUNT_OPERATORS
+        else:
+            allowed = isinstance(node, (ast.Load, ast.operator, ast.unaryop))
+        if not allowed:
+            raise ParseError(f"bad repeat count: {text}")
+    return tree
+
+def evaluate_count(tree, n):
+    # value of a syntax tree from parse_count
+    if isinstance(tree, ast.Constant):
+        return tree.value
+    if isinstance(tree, ast.Name):
+        return n if tree.id == "n" else COUNT_NAMES[tree.id]
+    if isinstance(tree, ast.Call):
+        return COUNT_FUNCTIONS[tree.func.id](*(evaluate_count(a, n) for a in tree.args))
+    if isinstance(tree, ast.UnaryOp):
+        return COUNT_OPERATORS[type(tree.op)](evaluate_count(tree.operand, n))
+    return COUNT_OPERATORS[type(tree.op)](evaluate_count(tree.left, n), evaluate_count(tree.right, n))
+
+class Compiler:
+    """
+    Lowers the lines of a QCode into Instructions. Qubit names are resolved to slots
+    of the frame's workspace list: the arguments take the first slots, then every
+    other name gets the next free slot in order of appearance
+    """
+    def __init__(self, arguments) -> None:
+        self.slots = {a: i for i, a in enumerate(arguments)}
+
+    def compile(self, content):
+        instructions, loops = [], []
+        for cmd in content:
+            instruction = self.compile_cmd(cmd)
+            if instruction.op == REPEAT:
+                loops.append(len(instructions))
+            elif instruction.op == END: # link the loop's REPEAT and END to each other
+                if len(loops) == 0:
+                    raise ParseError(f"end without repeat: {cmd}")
+                start = loops.pop()
+                count = instructions[start].args[0]
+                instructions[start] = instructions[start]._replace(args=(count, len(instructions)))
+                instruction = instruction._replace(args=(start,))
+            instructions.append(instruction)
+        if len(loops) > 0:
+            raise ParseError(f"repeat without end: {instructions[loops[-1]].line}")
+        return instructions
+
+    def slot(self, name):
+        name = name.strip()
+        if name not in self.slots:
+            self.slots[name] = len(self.slots)
+        return self.slots[name]
+
+    def slot_list(self, names):
+        names = names.strip()
+        if len(names) == 0:
+            return ()
+        return tuple(self.slot(n) for n in names.split(","))
+
+    def compile_cmd(self, cmd):
+        op, args = self.lower(cmd)
+        return Instruction(op, args, cmd)
+
+    def lower(self, cmd):
+        if cmd.startswith("new qubit"):
+            qs = [q.strip() for q in cmd.split("new qubit")[1].split(",")]
+            return NEW, (tuple(self.slot(q) for q in qs), tuple(qs))
+        elif cmd.startswith("extract"):
+            qs = [q.strip() for q in cmd.split("extract")[1].split(",")]
+            slots = None if qs[0] == "all" else tuple(self.slot(q) for q in qs)
+            return EXTRACT, (slots, "".join(qs))
+        elif cmd.startswith("shots"):
+            return SHOTS, (int(cmd.split("shots")[1].strip()),)
+        elif cmd.startswith("call"):
+            qcode = cmd.split("call")[1].split("(")[0].strip()
+            return CALL, (qcode, self.slot_list(cmd.split("(")[1].split(")")[0]))
+        elif cmd.startswith("print"):
+            return PRINT, ()
+        elif cmd.startswith("repeat"):
+            # a number, or an expression evaluated when the loop starts
+            return REPEAT, (parse_count(cmd.split("repeat")[1].strip()), None)
+        elif cmd.startswith("end"):
+            return END, (None,)
+        elif cmd.startswith("Hadamard"):
+            qs = [q.strip() for q in cmd.split("Hadamard")[1].split(",")]
+            return HADAMARD, (None if qs[0] == "all" else tuple(self.slot(q) for q in qs),)
+        elif cmd.startswith("toggle"):
+            return TOGGLE, (self.slot(cmd.split("toggle")[1]),)
+        elif cmd.startswith("if perp"):
+            code = cmd.split("if perp")[1].split("(")[0].strip()
+            return PERP, (code, self.slot_list(cmd.split("(")[1].split(")")[0]))
+        elif cmd.startswith("if"):
+            cond = cmd.split("if")[1].split("then")[0].strip()
+            if '(' in cond: # if f() then...
+                ccode = cond.split("(")[0].strip()
+                args = self.slot_list(cond.split("(")[1].split(")")[0])
+                if "minus" in cmd:
+                    return F_MINUS, (ccode, args)
+                return F_TOGGLE, (ccode, args, self.slot_list(cmd.split("toggle")[1]))
+            # CNOT, CCNOT, etc
+            conds = [c.strip() for c in cond.split(" ")]
+            if "minus" in cmd: # if A AND B ... then minus
+                if len(conds) % 2 == 0 or any(c != "AND" for c in conds[1::2]):
+                    raise ParseError(cmd)
+                return MINUS, (tuple(self.slot(c) for c in conds[::2]),)
+            target = self.slot(cmd.split("toggle")[1])
+            if len(conds) == 1: # if A then toggle B
+                return CNOT, (self.slot(conds[0]), target)
+            elif len(conds) == 2: # if not A then toggle B
+                assert conds[0] == "NOT"
+                return NOT_CNOT, (self.slot(conds[1]), target)
+            elif len(conds) == 3 and conds[1] == "AND":
+                return CCNOT, (self.slot(conds[0]), self.slot(conds[2]), target)
+            assert len(conds) == 3 and conds[1] == "OR"
+            return OR_CNOT, (self.slot(conds[0]), self.slot(conds[2]), target)
+        raise ParseError(cmd)
@@ -1,17 +1,81 @@
-import sys
+import argparse
+from collections import Counter
+from functools import partial
+import numpy as np
+import parse_cache
 from qc_simulator import QuantumComputer
+from memmap_simulator import MemmapQuantumComputer
+from sparse_simulator import SparseQuantumComputer
+from stabilizer_simulator import StabilizerQuantumComputer, NonCliffordError
+from mps_simulator import MPSQuantumComputer
+from shot_farm import farm
+from profiler import Profiler
 from qubit import Qubit
+from compiler import (NEW, EXTRACT, SHOTS, CALL, PRINT, REPEAT, END, HADAMARD, TOGGLE, CNOT, NOT_CNOT, CCNOT,
+                      OR_CNOT, MINUS, F_MINUS, F_TOGGLE, PERP, Compiler, ParseError, evaluate_count)
+
+# loops over more qubits than this always run their body directly
+MAX_POWER_QUBITS = 10
+# programs made only of these run on the clifford backend
+CLIFFORD_OPS = {NEW, EXTRACT, SHOTS, CALL, PRINT, REPEAT, END, HADAMARD, TOGGLE, CNOT, NOT_CNOT, MINUS}
 
 class CCode:
     """
     Represent function f : {0, 1}^n --> {0, 1}^m
     - file_name: name of AND/OR/NOT classical code
+    - line_nums: line numbers in file_name of the def, then of each line of content
     """
-    def __init__(self, arguments, ancillas, retvals, content) -> None:
+    def __init__(self, arguments, ancillas, retvals, content, file_name=None, line_nums=None) -> None:
         self.arguments = arguments
         self.ancillas = ancillas
         self.retvals = retvals
         self.content = content
+        self.file_name = file_name
+        self.line_nums = line_nums
+        self.table = None
+        self.sign_table = None
+
+    def evaluate(self, inputs):
+        """
+        Run f on arrays of bits, inputs[i] holding values of the i-th argument.
+        Returns one array per return value
+        """
+        values = dict(zip(self.arguments, inputs))
+        for line in self.content:
+            w, code = line.split(":=")
+            if "AND" in code:
+                a, b = code.split("AND")
+                value = values[a.strip()] & values[b.strip()]
+            elif "NOT" in code:
+                value = ~values[code.split("NOT")[1].strip()]
+            elif "OR" in code:
+                a, b = code.split("OR")
+                value = values[a.strip()] | values[b.strip()]
+            else:
+                value = values[code.strip()]
+            # each line toggles w, which starts at 0
+            w = w.strip()
+            values[w] = values[w] ^ value if w in values else value
+        return [values[r] for r in self.retvals]
+
+    def signs(self):
+        """
+        (-1)^f on every input for a single return value f, the phases of "if f then minus"
+        """
+        if self.sign_table is None:
+            self.sign_table = np.where(self.truth_table()[..., 0], -1, 1)
+        return self.sign_table
+
+    def truth_table(self):
+        """
+        f on every input, shape (2, ..., 2, m) indexed by the argument bits
+        """
+        if self.table is None:
+            n = len(self.arguments)
+            index = np.arange(2**n)
+            inputs = [(index >> (n - 1 - i)) & 1 == 1 for i in range(n)]
+            self.table = np.stack(self.evaluate(inputs), -1).reshape((2,) * n + (len(self.retvals),))
+        return self.table
 
     def get_line(self, num):
         return self.content[num]
@@ -20,9 +84,19 @@ class CCode:
         return num >= len(self.content)
 
 class QCode:
-    def __init__(self, arguments, content) -> None:
+    """
+    - name, file_name: where the code was defined, for the profiler
+    - line_nums: line number in file_name of each line of content
+    """
+    def __init__(self, arguments, content, name=None, file_name=None, line_nums=None) -> None:
         self.arguments = arguments
         self.content = content 
+        self.name = name
+        self.file_name = file_name
+        self.line_nums = line_nums
+        compiler = Compiler(arguments)
+        self.instructions = compiler.compile(content)
+        self.num_slots = len(compiler.slots)
     
     def get_line(self, num):
         return self.content[num]
@@ -31,26 +105,68 @@ class QCode:
         return num >= len(self.content)
 
 class QuantumInterpreter:
-    def __init__(self) -> None:
-        self.qc = QuantumComputer()
+    """
+    - compile_ccode: apply "if f(...) then" from the truth table of f instead of
+      running the gate-level expansion of the CCode with ancillas
+    - dtype: precision of the simulator's amplitudes, see QuantumComputer
+    - backend: class of the simulator: QuantumComputer, MemmapQuantumComputer for
+      registers larger than RAM, SparseQuantumComputer for states with few nonzero
+      amplitudes or MPSQuantumComputer for many weakly entangled qubits (options bound
+      with functools.partial)
+    - clifford_backend: used instead of backend when the program only has Hadamard,
+      toggle, CNOT, Z and CZ gates, None to always use backend
+    - seed: seed of the measurements, shared by every simulator the interpreter creates
+    - verbose: print states and extracted values, otherwise they are only kept in outcomes
+    - profiler: a profiler.Profiler timing every instruction and gate, None to run
+      without instrumentation
+    """
+    def __init__(self, compile_ccode=True, dtype=np.complex128, backend=QuantumComputer,
+                 seed=None, verbose=True, clifford_backend=StabilizerQuantumComputer, profiler=None) -> None:
+        self.compile_ccode = compile_ccode
+        self.dtype = dtype
+        self.backend = backend
+        self.clifford_backend = clifford_backend
+        self.rng = np.random.default_rng(seed)
+        self.verbose = verbose
+        self.profiler = profiler
+        self.qc = backend(dtype, seed=self.rng)
+        if profiler is not None:
+            profiler.attach(self.qc)
+        self.outcomes = [] # (label, extracted value) of each extract of the run
         self.qcodes = {}
         self.ccodes = {}
-        self.workspace = {}
+        self.workspace = []
         self.line_num = 0
         self.code = None
         self.stack = []
+        self.loops = [] # iterations left of the running loops of the current frame
+        self.loop_unitaries = {}
+        self.shots = None
+        self.handlers = {
+            NEW: self.op_new, EXTRACT: self.op_extract, SHOTS: self.op_shots,
+            CALL: self.op_call, PRINT: self.op_print, REPEAT: self.op_repeat, END: self.op_end,
+            HADAMARD: self.op_hadamard, TOGGLE: self.op_toggle, CNOT: self.op_cnot,
+            NOT_CNOT: self.op_not_cnot, CCNOT: self.op_ccnot, OR_CNOT: self.op_or_cnot,
+            F_MINUS: self.op_f_minus, F_TOGGLE: self.op_f_toggle, PERP: self.op_perp, MINUS: self.op_minus,
+        }
+        if profiler is not None: # run() itself stays free of profiling checks
+            self.handlers = {op: self.profiled(handler) for op, handler in self.handlers.items()}
     
     def reset_hard(self):
         self.qcodes = {}
         self.ccodes = {}
+        self.loop_unitaries = {}
         self.reset()
     
     def reset(self):
-        self.qc = QuantumComputer()
-        self.workspace = {}
+        self.code = self.qcodes.get("main")
+        self.qc = self.new_computer()
+        self.outcomes = []
+        self.workspace = []
         self.line_num = 0
-        self.code = None
         self.stack = []
+        self.loops = []
+        self.shots = None
 
     # Parse files
     def parse(self, file_name):
@@ -59,240 +175,359 @@ class QuantumInterpreter:
         self.code = self.qcodes["main"]
         for ccode in self.ccodes:
             self.ccode_to_qcode(ccode)
+        self.qc = self.new_computer()
+
+    def new_computer(self):
+        backend = self.backend
+        if self.clifford_backend is not None and self.code is not None and self.is_clifford(self.code):
+            backend = self.clifford_backend
+        qc = backend(self.dtype, seed=self.rng)
+        if self.profiler is not None:
+            self.profiler.attach(qc)
+        return qc
+
+    def is_clifford(self, code, seen=()):
+        # whether code and everything it calls only use CLIFFORD_OPS
+        for op, args, _ in code.instructions:
+            if op == CALL:
+                callee = self.qcodes[args[0]]
+                if callee not in seen and not self.is_clifford(callee, seen + (callee,)):
+                    return False
+            elif op == MINUS and len(args[0]) > 2: # Z and CZ only
+                return False
+            elif op not in CLIFFORD_OPS:
+                return False
+        return True
 
     def parse_qcode(self, file_name, code_name=None):
         if ".qcode" not in file_name:
             file_name += ".qcode"
-        lines = self.get_lines(file_name)
-        name, arguments, content = None, [], []
-        for line in lines:
-            if line.startswith("QCode"):
-                qcodes = line[5:].strip().split(",")
-                for qcode in qcodes:
-                    c_name = qcode.split(":")[1].strip()
-                    if c_name == "*": c_name = None
-                    file_name = qcode.split(':')[0].strip()
-                    self.parse_qcode(file_name, c_name)
-            elif line.startswith("CCode"):
-                ccodes = line[5:].strip().split(",")
-                for ccode in ccodes:
-                    c_name = ccode.split(":")[1].strip()
-                    if c_name == "*": c_name = None
-                    file_name = ccode.split(":")[0].strip()
-                    self.parse_ccode(file_name, c_name)
-            elif line.startswith("def"):
-                if name is not None and (code_name is None or code_name == name):
-                    self.qcodes[name] = QCode(arguments, content)
-                name, arguments, content = None, [], []
-                name = line.split("def")[1].split("(")[0].strip()
-                arguments = [a.strip() for a in line.split("(")[1].split(")")[0].strip().split(',')]
+        imports, codes = parse_cache.load(file_name, read_qcode)
+        for kind, imported, c_name in imports:
+            if kind == "QCode":
+                self.parse_qcode(imported, c_name)
             else:
-                content.append(line)
-
-        if code_name is None or code_name == name:
-            self.qcodes[name] = QCode(arguments, content)                
+                self.parse_ccode(imported, c_name)
+        for name, qcode in codes:
+            if code_name is None or code_name == name:
+                self.qcodes[name] = qcode
 
     def parse_ccode(self, file_name, code_name=None):
         if ".ccode" not in file_name:
             file_name += ".ccode"
-        lines = self.get_lines(file_name)
-        name, arguments, ancillas, retvals, content = None, [], [], [], []
-        for line in lines:
-            if line.startswith("def"):
-                if name is not None and (code_name is None or code_name == name):
-                    self.ccodes[name] = CCode(arguments, ancillas, retvals, content)
-                name, arguments, ancillas, retvals, content = None, [], [], [], []
-                name = line.split("def")[1].split("(")[0].strip()
-                arguments = [a.strip() for a in line.split("(")[1].split(")")[0].strip().split(',')]
-            elif line.startswith("return"):
-                retvals = [r.strip() for r in line.split("return")[1].split(",")]
-            else:
-                ancillas.append(line.split(":=")[0].strip())
-                content.append(line)
-        if name is not None and (code_name is None or code_name == name):
-            self.ccodes[name] = CCode(arguments, ancillas, retvals, content)
-
-    def get_lines(self, file_name):
-        lines = []
-        with open(file_name, 'r') as file:
-            for line in file:
-                line = line.strip()
-                if len(line) == 0 or line.startswith("#"): continue
-                lines.append(line)
-        return lines
-
-    def run(self):
-        while not self.code.end_file(self.line_num):
-            line = self.code.get_line(self.line_num)
+        for name, ccode in parse_cache.load(file_name, read_ccode):
+            if code_name is None or code_name == name:
+                self.ccodes[name] = ccode
+
+    # Execution of compiled instructions
+    def run(self, stop=None):
+        if len(self.workspace) < self.code.num_slots:
+            self.workspace = [None] * self.code.num_slots
+        instructions = self.code.instructions
+        if stop is None:
+            stop = len(instructions)
+        while self.line_num < stop:
+            op, args, _ = instructions[self.line_num]
             self.line_num += 1
-
-            self.process_cmd(line)
-
-            if self.code.end_file(self.line_num) and len(self.stack) > 0:
-                frame = self.stack.pop()
-                self.workspace = frame.workspace
-                self.code = frame.code
-                self.line_num = frame.line_num 
-
-    def process_cmd(self, cmd):
-        if cmd.startswith("new qubit"):
-            qs = [q.strip() for q in cmd.split("new qubit")[1].split(",")]
-            qbs = []
-            for q in qs:
-                qubit = Qubit(q)
-                self.workspace[q] = qubit
-                qbs.append(qubit)
-            self.qc.new_qubit(*qbs)
-        elif cmd.startswith("extract"):
-            qs = [q.strip() for q in cmd.split("extract")[1].split(",")]
-            if qs[0] == "all":
-                qbs = self.workspace.values()
-            else:
-                qbs = [self.workspace[q] for q in qs]
-            out = self.qc.extract(*qbs)
-            print(f"Extracted {''.join(qs)}: {out}")
-        elif cmd.startswith("call"):
-            qcode = cmd.split("call")[1].split("(")[0].strip()
-            arg_string = cmd.split("(")[1].split(")")[0]
-            if len(arg_string) == 0:
-                args = []
-            else:
-                args = [a.strip() for a in cmd.split("(")[1].split(")")[0].split(",")]
-
-            # save current frame
-            frame = Frame(self.workspace, self.code, self.line_num)
-            self.stack.append(frame)
-
-            # change frame to new qcode
-            self.code = self.qcodes[qcode]
-            self.line_num = 0
-            new_ws = {}
-            for i in range(len(args)):
-                new_ws[self.code.arguments[i]] = self.workspace[args[i]]
-            self.workspace = new_ws
-        elif cmd.startswith("print"):
+            self.handlers[op](*args)
+
+    def profiled(self, handler):
+        # handler recorded by the profiler under the instruction being run
+        def run(*args):
+            self.profiler.enter(self.location(self.code, self.line_num - 1))
+            try:
+                handler(*args)
+            finally:
+                self.profiler.exit(self.qc)
+        return run
+
+    def location(self, code, i):
+        """
+        "file:line code: command" of instruction i of code
+        """
+        where = code.file_name or "?"
+        if code.line_nums is not None and code.line_nums[i] is not None:
+            where += f":{code.line_nums[i]}"
+        return f"{where} {code.name}: {code.instructions[i].line}"
+
+    def enter(self, code, arg_slots):
+        """
+        Run code in a new frame with the qubits in arg_slots as its arguments
+        """
+        workspace = [None] * code.num_slots
+        for i, slot in enumerate(arg_slots):
+            workspace[i] = self.workspace[slot]
+
+        # save current frame
+        self.stack.append(Frame(self.workspace, self.code, self.line_num, self.loops))
+        self.code, self.workspace, self.line_num, self.loops = code, workspace, 0, []
+        self.run()
+        frame = self.stack.pop()
+        self.workspace, self.code, self.line_num, self.loops = frame.workspace, frame.code, frame.line_num, frame.loops
+
+    def qubits(self, slots):
+        if slots is None: # all, leaving out those already extracted
+            live = self.live_qubits()
+            return [q for q in self.workspace if q is not None and q in live]
+        return [self.workspace[s] for s in slots]
+
+    def live_qubits(self):
+        # qubits still in the computer
+        return set(self.qc.qubits)
+
+    def op_new(self, slots, names):
+        qbs = []
+        for slot, name in zip(slots, names):
+            qubit = Qubit(name)
+            self.workspace[slot] = qubit
+            qbs.append(qubit)
+        self.qc.new_qubit(*qbs)
+
+    def op_extract(self, slots, label):
+        qbs = self.qubits(slots)
+        if self.shots is not None and self.verbose: # histogram over many shots, state is left intact
+            counts = self.qc.sample(self.shots, qbs)
+            print(f"Sampled {label} x{self.shots}: {dict(sorted(counts.items()))}")
+        out = self.qc.extract(*qbs)
+        self.outcomes.append((label, out))
+        if self.verbose:
+            print(f"Extracted {label}: {out}")
+
+    def op_shots(self, shots):
+        self.shots = shots
+
+    def op_call(self, name, arg_slots):
+        self.enter(self.qcodes[name], arg_slots)
+
+    def op_print(self):
+        if self.verbose:
             self.qc.print_state()
-        elif cmd.startswith("repeat"):
-            pass
-        elif cmd.startswith("end"):
-            pass
-        elif cmd.startswith("Hadamard"):
-            qs = [q.strip() for q in cmd.split("Hadamard")[1].split(",")]
-            if qs[0] == "all":
-                qs = self.workspace.values()
-            else:
-                qs = [self.workspace[q] for q in qs]
-            self.qc.hadamard(*qs)
-        elif cmd.startswith("toggle"):
-            q = cmd.split("toggle")[1].strip()
-            self.qc.toggle(self.workspace[q])
-        elif cmd.startswith("if perp"):
-            code = cmd.split("if perp")[1].split("(")[0].strip()
-            forward = self.qcodes[code]
-            arg_string = cmd.split("(")[1].split(")")[0]
-            if len(arg_string) == 0:
-                args = []
+
+    def op_repeat(self, count, end):
+        if not isinstance(count, int): # expression of n, the number of qubits in the frame
+            count = int(evaluate_count(count, len(self.qubits(None))))
+        if count <= 0:
+            self.line_num = end + 1
+            return
+        cost = self.unitary_cost(self.code.instructions[self.line_num:end])
+        if cost is not None and self.power_is_cheaper(count, cost):
+            qubits = self.qubits(None)
+            unitary = np.linalg.matrix_power(self.loop_unitary(self.line_num - 1, end), count)
+            self.qc.multi_qubit_op(qubits, unitary)
+            self.line_num = end + 1
+            return
+        self.loops.append(count)
+
+    def op_end(self, start):
+        self.loops[-1] -= 1
+        if self.loops[-1] > 0:
+            self.line_num = start + 1
+        else:
+            self.loops.pop()
+
+    # Loops with a fixed unitary body
+    def unitary_cost(self, instructions, seen=()):
+        """
+        Number of gates run by instructions, or None if they do anything but unitary gates
+        on the qubits that already exist (new qubits, measurements, prints, ...)
+        """
+        cost = 0
+        for op, args, _ in instructions:
+            if op == CALL:
+                code = self.qcodes[args[0]]
+                callee = None if code in seen else self.unitary_cost(code.instructions, seen + (code,))
+                if callee is None:
+                    return None
+                cost += callee
+            elif op in (F_MINUS, F_TOGGLE):
+                if not (self.compile_ccode and args[0] in self.ccodes):
+                    return None
+                cost += 1
+            elif op in (HADAMARD, TOGGLE, CNOT, NOT_CNOT, CCNOT, OR_CNOT, MINUS, PERP, REPEAT, END):
+                cost += 1
             else:
-                args = [a.strip() for a in cmd.split("(")[1].split(")")[0].split(",")]
-            undo_code = self.undo_qcode(code)
-
-            # TODO
-        elif cmd.startswith("if"):
-            cond = cmd.split("if")[1].split("then")[0].strip()
-            if '(' in cond: # if f() then...
-                ccode = cond.split("(")[0].strip()
-                args_string = cond.split("(")[1].split(")")[0]
-                if len(args_string) == 0:
-                    args = []
-                else:
-                    args = [a.strip() for a in args_string.split(",")]
-                
-                if "minus" in cmd: # if f then minux
-                    new_code = self.qcodes[f"if_{ccode}_then_minus"]
-                else:
-                    cs = [c.strip() for c in cmd.split("toggle")[1].strip().split(",")]
-                    args += cs
-                    if len(cs) == 1:
-                        new_code = self.qcodes[f"if_{ccode}_then_toggle"]
-                    else:
-                        new_code = self.qcodes[f"if_{ccode}_then_toggle_onto"]
-
-                # save frame
-                frame = Frame(self.workspace, self.code, self.line_num)
-                self.stack.append(frame)
-
-                # change to new frame
-                self.code = new_code
-                self.line_num = 0
-                new_ws = {}
-                for i in range(len(args)):
-                    new_ws[self.code.arguments[i]] = self.workspace[args[i]]
-                self.workspace = new_ws
-            else: # CNOT, CCNOT, etc
-                conds = [c.strip() for c in cond.split(" ")]
-                if len(conds) == 1: # if A then toggle B
-                    A = self.workspace[conds[0]]
-                    B = self.workspace[cmd.split("toggle")[1].strip()]
-                    self.qc.if_A_then_toggle_B(A, B)
-                elif len(conds) == 2: # if not A then toggle B
-                    assert conds[0] == "NOT"
-                    A = self.workspace[conds[1]]
-                    B = self.workspace[cmd.split("toggle")[1].strip()]
-                    self.qc.if_not_A_then_toggle_B(A, B)
-                elif len(conds) == 3 and conds[1] == "AND":
-                    A = self.workspace[conds[0]]
-                    B = self.workspace[conds[2]]
-                    C = self.workspace[cmd.split("toggle")[1].strip()]
-                    self.qc.if_A_and_B_then_toggle_C(A, B, C)
-                else:
-                    assert len(conds) == 3 and conds[1] == "OR"
-                    A = self.workspace[conds[0]]
-                    B = self.workspace[conds[2]]
-                    C = self.workspace[cmd.split("toggle")[1].strip()]
-                    self.qc.if_A_or_B_then_toggle_C(A, B, C)
+                return None
+        return cost
+
+    def power_is_cheaper(self, count, cost):
+        """
+        Compare running the loop body count times on the whole state with building the
+        body's 2^k x 2^k unitary on the k qubits of the frame and raising it to count
+        """
+        k, n = len(self.qubits(None)), len(self.qc.qubits)
+        if k > MAX_POWER_QUBITS or isinstance(self.qc, StabilizerQuantumComputer):
+            return False
+        if isinstance(self.qc, MemmapQuantumComputer) and k > self.qc.chunk_qubits: # too big for a chunk
+            return False
+        direct = count * cost * 2**n
+        power = cost * 4**k + np.log2(count) * 8**k + 2**(n + k)
+        return power < direct
+
+    def loop_unitary(self, start, end):
+        """
+        Unitary of the loop body from REPEAT at start to END at end over the frame's qubits,
+        found by running the body on every basis state. Cached per loop and frame layout
+        """
+        live = self.live_qubits()
+        bound = tuple(i for i, q in enumerate(self.workspace) if q is not None and q in live)
+        key = (self.code, start, bound)
+        if key not in self.loop_unitaries:
+            qubits = self.qubits(None)
+            saved = self.qc, self.line_num, self.loops
+            columns = []
+            for b in range(2**len(qubits)):
+                self.qc = QuantumComputer(self.dtype)
+                self.qc.new_qubit(*qubits)
+                self.qc.materialize(qubits)
+                self.qc.state[0] = 0
+                self.qc.state[b] = 1
+                self.line_num, self.loops = start + 1, []
+                self.run(stop=end)
+                columns.append(np.array(self.qc.amplitudes()))
+            self.qc, self.line_num, self.loops = saved
+            self.loop_unitaries[key] = np.stack(columns, axis=1)
+        return self.loop_unitaries[key]
+
+    def op_hadamard(self, slots):
+        self.qc.hadamard(*self.qubits(slots))
+
+    def op_toggle(self, slot):
+        self.qc.toggle(self.workspace[slot])
+
+    def op_cnot(self, A, B):
+        self.qc.if_A_then_toggle_B(self.workspace[A], self.workspace[B])
+
+    def op_not_cnot(self, A, B):
+        self.qc.if_not_A_then_toggle_B(self.workspace[A], self.workspace[B])
+
+    def op_ccnot(self, A, B, C):
+        self.qc.if_A_and_B_then_toggle_C(self.workspace[A], self.workspace[B], self.workspace[C])
+
+    def op_or_cnot(self, A, B, C):
+        self.qc.if_A_or_B_then_toggle_C(self.workspace[A], self.workspace[B], self.workspace[C])
+
+    def op_minus(self, slots):
+        self.qc.multi_controlled_Z(*self.qubits(slots))
+
+    def op_f_minus(self, name, arg_slots):
+        if self.compile_ccode and name in self.ccodes:
+            self.qc.if_f_then_minus(self.ccodes[name], *self.qubits(arg_slots))
+        else:
+            self.enter(self.qcodes[f"if_{name}_then_minus"], arg_slots)
+
+    def op_f_toggle(self, name, arg_slots, target_slots):
+        if self.compile_ccode and name in self.ccodes:
+            self.qc.toggle_f_onto_Cs(self.ccodes[name], *self.qubits(arg_slots + target_slots))
+        elif len(target_slots) == 1:
+            self.enter(self.qcodes[f"if_{name}_then_toggle"], arg_slots + target_slots)
         else:
-            raise ParseError
+            self.enter(self.qcodes[f"if_{name}_then_toggle_onto"], arg_slots + target_slots)
+
+    def op_perp(self, name, arg_slots):
+        """
+        Reflection about U|0...0>, U being the QCode name: the states perpendicular to it
+        get -1. That is undo U, -1 on every basis state but |0...0>, then U, unless U is
+        Hadamard on each of its arguments, where it is the closed form 2|s><s| - I
+        """
+        qubits = self.qubits(arg_slots)
+        if self.is_hadamard_all(self.qcodes[name]):
+            self.qc.reflect_uniform(qubits)
+            return
+        self.enter(self.undo_qcode(name), arg_slots)
+        mask = np.ones((2,) * len(qubits), bool)
+        mask[(0,) * len(qubits)] = False
+        self.qc.apply_phase(mask, qubits)
+        self.enter(self.qcodes[name], arg_slots)
+
+    def is_hadamard_all(self, code):
+        # whether code only applies Hadamard, an odd number of times to each argument
+        counts = [0] * len(code.arguments)
+        if code.num_slots > len(code.arguments):
+            return False
+        for op, args, _ in code.instructions:
+            if op != HADAMARD:
+                return False
+            for slot in range(len(counts)) if args[0] is None else args[0]:
+                counts[slot] += 1
+        return all(count % 2 == 1 for count in counts)
 
     def undo_qcode(self, name):
+        """
+        QCode undo_name undoing the QCode name: its lines in reverse order, a call calling
+        the callee's undo and a repeat block staying a block around its undone body. The
+        other lines are their own inverse. Raises ParseError for new and extract, which
+        cannot be undone
+        """
         if f"undo_{name}" not in self.qcodes:
             forward = self.qcodes[name]
-            args, content = forward.arguments, forward.content
-            self.qcodes[f"undo_{name}"] = QCode(args, content.reverse())
+            order = self.undo_order(forward.instructions, 0, len(forward.instructions))
+            content = []
+            for i in order:
+                op, args, line = forward.instructions[i]
+                if op == NEW or op == EXTRACT:
+                    raise ParseError(f"cannot undo {name}: {line}")
+                if op == CALL:
+                    self.undo_qcode(args[0])
+                    line = f"call undo_{args[0]}(" + line.split("(", 1)[1]
+                content.append(line)
+            nums = None if forward.line_nums is None else [forward.line_nums[i] for i in order]
+            self.qcodes[f"undo_{name}"] = QCode(forward.arguments, content, f"undo_{name}", forward.file_name, nums)
         return self.qcodes[f"undo_{name}"]
 
+    def undo_order(self, instructions, start, stop):
+        # indices of instructions[start:stop] in the order that undoes them
+        blocks, i = [], start
+        while i < stop:
+            if instructions[i].op == REPEAT:
+                end = instructions[i].args[1]
+                blocks.append([i] + self.undo_order(instructions, i + 1, end) + [end])
+                i = end + 1
+            else:
+                blocks.append([i])
+                i += 1
+        return [j for block in blocks[::-1] for j in block]
+
     def ccode_to_qcode(self, name):
         ccode = self.ccodes[name]
         cargs, retvals, ancillas, lines = ccode.arguments, ccode.retvals, ccode.ancillas, ccode.content
         rargs = [f"C{i}" for i in range(len(retvals))]
         args = cargs + rargs
+        # lines computing or uncomputing f map to their CCode line, the others to its def
+        nums = ccode.line_nums or [None] * (len(lines) + 1)
+        line_nums = []
 
         content = []
 
         content.append("new qubit " + ", ".join(ancillas))
+        line_nums.append(nums[0])
 
         for line in lines:
             content.append(self.ccmd_to_qcmd(line, args, cargs))
+        line_nums.extend(nums[1:])
         
         for i in range(len(retvals)):
             rv = retvals[i]
             cv = rargs[i]
             content.append(f"if {rv} then toggle {cv}")
+            line_nums.append(nums[0])
 
         for i in range(len(lines)-1, -1, -1):
             line = lines[i]
             content.append(self.ccmd_to_qcmd(line, args, cargs))
+        line_nums.extend(nums[:0:-1])
 
         content.append(f"extract {', '.join(ancillas)}")
+        line_nums.append(nums[0])
 
-        qcode = QCode(args, content)
         if len(rargs) == 1: # if f then toggle C 
-            self.qcodes[f"if_{name}_then_toggle"] = qcode
-            # if f then minus
-            content = ["new qubit C0", "toggle C0", "Hadamard C0"] + content + ["Hadamard C0", "toggle C0", "extract C0"]
-            qcode = QCode(cargs, content)
-            self.qcodes[f"if_{name}_then_minus"] = qcode
+            self.qcodes[f"if_{name}_then_toggle"] = QCode(args, content, name, ccode.file_name, line_nums)
+            # if f then minus: a phase on f's ancilla between computing and uncomputing f,
+            # instead of toggling a C prepared in |->
+            content = [f"if {retvals[0]} then minus" if line == f"if {retvals[0]} then toggle C0" else line
+                       for line in content]
+            self.qcodes[f"if_{name}_then_minus"] = QCode(cargs, content, name, ccode.file_name, line_nums)
         else: # toggle f onto Cs
-            self.qcodes[f"if_{name}_then_toggle_onto"] = qcode
+            self.qcodes[f"if_{name}_then_toggle_onto"] = QCode(args, content, name, ccode.file_name, line_nums)
 
     def ccmd_to_qcmd(self, ccmd, args, cargs):
         w, code = ccmd.split(":=")
@@ -312,18 +547,142 @@ class QuantumInterpreter:
             a = code.strip()
             return f"if {a} then toggle {w}"
 
+def get_lines(file_name):
+    """
+    Non-empty, non-comment lines of a file as (line number, line)
+    """
+    lines = []
+    with open(file_name, 'r') as file:
+        for num, line in enumerate(file, 1):
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"): continue
+            lines.append((num, line))
+    return lines
+
+def read_qcode(file_name):
+    """
+    Parse a .qcode file into its imports [(kind, file, name or None)] and its
+    definitions [(name, QCode)]
+    """
+    imports, codes = [], []
+    name, arguments, content, line_nums = None, [], [], []
+    for num, line in get_lines(file_name):
+        if line.startswith("QCode") or line.startswith("CCode"):
+            for code in line[5:].strip().split(","):
+                c_name = code.split(":")[1].strip()
+                if c_name == "*": c_name = None
+                imports.append((line[:5], code.split(":")[0].strip(), c_name))
+        elif line.startswith("def"):
+            if name is not None:
+                codes.append((name, QCode(arguments, content, name, file_name, line_nums)))
+            name, arguments, content, line_nums = None, [], [], []
+            name = line.split("def")[1].split("(")[0].strip()
+            arguments = [a.strip() for a in line.split("(")[1].split(")")[0].strip().split(',')]
+        else:
+            content.append(line)
+            line_nums.append(num)
+    codes.append((name, QCode(arguments, content, name, file_name, line_nums)))
+    return imports, codes
+
+def read_ccode(file_name):
+    """
+    Parse a .ccode file into its definitions [(name, CCode)]
+    """
+    codes = []
+    name, arguments, ancillas, retvals, content, line_nums = None, [], [], [], [], []
+    for num, line in get_lines(file_name):
+        if line.startswith("def"):
+            if name is not None:
+                codes.append((name, CCode(arguments, ancillas, retvals, content, file_name, line_nums)))
+            name, arguments, ancillas, retvals, content, line_nums = None, [], [], [], [], [num]
+            name = line.split("def")[1].split("(")[0].strip()
+            arguments = [a.strip() for a in line.split("(")[1].split(")")[0].strip().split(',')]
+        elif line.startswith("return"):
+            retvals = [r.strip() for r in line.split("return")[1].split(",")]
+        else:
+            ancillas.append(line.split(":=")[0].strip())
+            content.append(line)
+            line_nums.append(num)
+    if name is not None:
+        codes.append((name, CCode(arguments, ancillas, retvals, content, file_name, line_nums)))
+    return codes
+
+def run_program(file_name, shots, seed, options={}):
+    """
+    Run a program shots times without printing. Returns a Counter of the outcomes of
+    the runs, each the tuple of (label, value) of its extracts. A task for shot_farm.farm
+    """
+    interpreter = QuantumInterpreter(seed=seed, verbose=False, **options)
+    interpreter.parse(file_name)
+    counts = Counter()
+    for _ in range(shots):
+        interpreter.reset()
+        interpreter.run()
+        counts[tuple(interpreter.outcomes)] += 1
+    return counts
+
 class Frame:
-    def __init__(self, workspace, code, line_num) -> None:
+    def __init__(self, workspace, code, line_num, loops) -> None:
         self.workspace = workspace 
         self.code = code 
         self.line_num = line_num 
-
-class ParseError(Exception):
-    pass
+        self.loops = loops
 
 if __name__=="__main__":
-    file_name = sys.argv[1]
-
-    interpreter = QuantumInterpreter()
-    interpreter.parse(file_name)
-    interpreter.run()
+    parser = argparse.ArgumentParser(description="Run a QCode program")
+    parser.add_argument("file_name")
+    parser.add_argument("--backend", choices=["auto", "memory", "memmap", "sparse", "stabilizer", "mps"],
+                        default="auto",
+                        help="keep the state in RAM, in memory-mapped files, only its nonzero amplitudes, as "
+                             "a stabilizer tableau or as a matrix product state. auto uses the tableau for programs with only Hadamard, "
+                             "toggle, CNOT, Z and CZ gates and RAM otherwise")
+    parser.add_argument("--dtype", choices=["complex128", "complex64", "float32"], default="complex128")
+    parser.add_argument("--chunk-qubits", type=int, default=20,
+                        help="memmap backend: log2 of the amplitudes processed at a time")
+    parser.add_argument("--directory", default=None, help="memmap backend: where to put the state files")
+    parser.add_argument("--max-bond", type=int, default=64, help="mps backend: largest bond dimension")
+    parser.add_argument("--cutoff", type=float, default=1e-12,
+                        help="mps backend: drop singular values whose squared weight is below this")
+    parser.add_argument("--threads", type=int, default=None, help="run gates on this many threads")
+    parser.add_argument("--shots", type=int, default=None,
+                        help="run the program this many times and print a histogram of the extracted values")
+    parser.add_argument("--workers", type=int, default=None, help="processes running the shots, one per core by default")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the measurements, for reproducible runs")
+    parser.add_argument("--profile", default=None,
+                        help="time every instruction and gate, write their stacks to this file in the collapsed "
+                             "format of flame graphs and print a summary")
+    args = parser.parse_args()
+    if args.profile is not None and args.shots is not None:
+        parser.error("--profile runs the program once, without --shots")
+
+    backend = partial(QuantumComputer, threads=args.threads)
+    if args.backend == "memmap":
+        backend = partial(MemmapQuantumComputer, chunk_qubits=args.chunk_qubits, directory=args.directory,
+                          threads=args.threads)
+    elif args.backend == "sparse":
+        backend = partial(SparseQuantumComputer, threads=args.threads)
+    elif args.backend == "stabilizer":
+        backend = StabilizerQuantumComputer
+    elif args.backend == "mps":
+        backend = partial(MPSQuantumComputer, max_bond=args.max_bond, cutoff=args.cutoff)
+    clifford_backend = StabilizerQuantumComputer if args.backend == "auto" else None
+    try:
+        if args.shots is not None:
+            options = {"dtype": args.dtype, "backend": backend, "clifford_backend": clifford_backend}
+            counts = farm(partial(run_program, args.file_name, options=options), args.shots, args.workers, args.seed)
+            for outcome, count in sorted(counts.items()):
+                print(", ".join(f"{label}={out}" for label, out in outcome) + f": {count}")
+        else:
+            profiler = Profiler() if args.profile is not None else None
+            interpreter = QuantumInterpreter(dtype=args.dtype, backend=backend, seed=args.seed,
+                                             clifford_backend=clifford_backend, profiler=profiler)
+            interpreter.parse(args.file_name)
+            interpreter.run()
+            if profiler is not None:
+                profiler.close()
+                profiler.write_collapsed(args.profile)
+                profiler.print_summary()
+            if args.backend == "mps":
+                print(f"Truncation error: {interpreter.qc.truncation_error:.3g}")
+    except NonCliffordError as error: # e.g. --backend stabilizer on a program with Toffolis
+        parser.exit(1, f"error: {error}\n")
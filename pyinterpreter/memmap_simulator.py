@@ -0,0 +1,289 @@
+import os
+import tempfile
+import numpy as np
+from qc_simulator import QuantumComputer
+
+class MemmapQuantumComputer(QuantumComputer):
+    """
+    Out-of-core state vector for registers that don't fit in RAM. The two amplitude
+    buffers are np.memmap files, split into chunks of 2^chunk_qubits amplitudes, and
+    every gate streams over the chunks in file order so only one or two chunks are in
+    memory at a time.
+    The amplitudes are stored in the order of self.layout, which may differ from
+    self.qubits (the order outcomes are reported in). The last chunk_qubits qubits of
+    the layout index amplitudes inside a chunk ("local" qubits), the others pick the
+    chunk ("global" qubits). Gates that need a global qubit inside a chunk first swap
+    it with a local qubit and keep the new layout.
+    - chunk_qubits: log2 of the number of amplitudes per chunk
+    - directory: where the memmap files are created, a temporary directory by default
+    - threads: threads used to run the gates on each chunk, see QuantumComputer
+    - seed: seed or np.random.Generator for the measurements
+    """
+    def __init__(self, dtype=np.complex128, chunk_qubits=20, directory=None, threads=None, seed=None) -> None:
+        super().__init__(dtype, seed=seed)
+        self.chunk_qubits = chunk_qubits
+        self.layout = []
+        self.folder = tempfile.TemporaryDirectory(dir=directory)
+        self.buffers = [self.open(os.path.join(self.folder.name, f"state{i}"), 1) for i in range(2)]
+        self.buffers[0][0] = 1
+        self.state, self.scratch = self.buffers
+        # in-memory computer over the local qubits that runs the gates on one chunk
+        self.worker = QuantumComputer(dtype, threads)
+
+    # Qubit creation and deletion
+    def new_qubit(self, *args):
+        # new qubits go first in the layout: the state becomes [old state, 0, ..., 0]
+        old = self.state.size
+        self.layout = list(args) + self.layout
+        self.axes = {q: p for p, q in enumerate(self.layout)}
+        self.qubits.extend(args)
+        self.resize(old * 2**len(args))
+        for start in range(old, self.state.size, self.chunk_size()):
+            self.state[start:start + self.chunk_size()] = 0
+
+    def extract(self, *args):
+        if len(args) == 0:
+            return self.extract_all()
+
+        probs = self.marginal_probs(args).reshape(-1)
+        outcome = self.choose(probs)
+        output = self.index_to_basic_state(outcome, len(args))
+        norm = np.sqrt(probs[outcome])
+
+        # condition on measurement, writing the kept amplitudes to scratch in layout order
+        bits = dict(zip(args, map(int, output)))
+        local = [q for q in args if self.is_local(q)]
+        offset = 0
+        for i, chunk in self.chunks():
+            if any(self.chunk_bit(i, q) != bits[q] for q in args if q not in local):
+                continue
+            self.load(chunk)
+            tensor, axes = self.worker.tensor(*local)
+            index = [slice(None)] * tensor.ndim
+            for q, axis in zip(local, axes):
+                index[axis] = bits[q]
+            kept = tensor[tuple(index)]
+            self.scratch[offset:offset + kept.size] = kept.reshape(-1) / norm
+            offset += kept.size
+        self.flip()
+        self.resize(offset)
+        self.remove_qubits(args)
+
+        return output
+
+    def extract_all(self):
+        totals = np.array([np.sum(self.load(chunk)) for _, chunk in self.chunks()])
+        i = self.choose(totals)
+        k = self.choose(self.load(self.state[i * self.chunk_size():(i + 1) * self.chunk_size()]))
+        output = self.layout_to_basic_state(i * self.chunk_size() + k)
+
+        self.set_layout([])
+        self.buffers[0][0] = 1
+        self.resize(1)
+        return output
+
+    def sample(self, shots, qubits=None):
+        if qubits is not None and list(qubits) != self.qubits:
+            return super().sample(shots, qubits)
+        # every qubit in order: split the shots between the chunks, then inside each chunk
+        totals = np.array([np.sum(self.load(chunk)) for _, chunk in self.chunks()])
+        histogram = {}
+        counts = self.rng.multinomial(shots, totals / np.sum(totals))
+        for i, chunk in self.chunks():
+            if counts[i] == 0:
+                continue
+            probs = self.load(chunk)
+            chunk_counts = self.rng.multinomial(counts[i], probs / np.sum(probs))
+            for k in np.flatnonzero(chunk_counts):
+                histogram[self.layout_to_basic_state(i * self.chunk_size() + k)] = int(chunk_counts[k])
+        return histogram
+
+    def marginal(self, *qubits):
+        probs = self.marginal_probs(qubits).reshape(-1)
+        return None, None, probs
+
+    def marginal_probs(self, qubits):
+        """
+        Joint distribution of measuring qubits with shape (2, ..., 2), streamed over the
+        chunks: the bits of global qubits are fixed within a chunk
+        """
+        probs = np.zeros((2,) * len(qubits))
+        local = [q for q in qubits if self.is_local(q)]
+        for i, chunk in self.chunks():
+            chunk_probs = self.load(chunk)
+            index = tuple(slice(None) if q in local else self.chunk_bit(i, q) for q in qubits)
+            if len(local) == 0:
+                probs[index] += np.sum(chunk_probs)
+            else:
+                _, _, marginal = self.worker.marginal(*local)
+                probs[index] += marginal.reshape((2,) * len(local))
+        return probs
+
+    # Gates
+    def hadamard(self, *qubits):
+        # local qubits by the worker's Walsh-Hadamard transform on each chunk, global ones
+        # by combining pairs of chunks
+        if len(qubits) == 0:
+            qubits = self.qubits
+        local = [q for q in qubits if self.is_local(q)]
+        if len(local) > 0:
+            self.each_chunk("hadamard", local, *local)
+        for qubit in qubits:
+            if qubit not in local:
+                self.hadamard_single(qubit)
+
+    def single_qubit_op(self, qubit, op):
+        if self.is_local(qubit):
+            self.each_chunk("single_qubit_op", [qubit], qubit, op)
+            return
+        # global qubit: combine the pairs of chunks that differ in its bit
+        op = self.cast(op)
+        size = self.chunk_size()
+        for i, j in self.chunk_pairs(qubit):
+            a = np.array(self.state[i * size:(i + 1) * size])
+            b = np.array(self.state[j * size:(j + 1) * size])
+            self.state[i * size:(i + 1) * size] = op[0, 0] * a + op[0, 1] * b
+            self.state[j * size:(j + 1) * size] = op[1, 0] * a + op[1, 1] * b
+
+    def multi_qubit_op(self, qubits, op):
+        self.each_chunk("multi_qubit_op", qubits, qubits, op)
+
+    def controlled_toggle(self, target, controls=(), zero_controls=()):
+        # global controls select whole chunks, only the target needs to be local
+        self.localize([target])
+        wanted = ([(q, 1) for q in controls if not self.is_local(q)]
+                  + [(q, 0) for q in zero_controls if not self.is_local(q)])
+        for i, chunk in self.chunks():
+            if all(self.chunk_bit(i, q) == bit for q, bit in wanted):
+                self.load(chunk)
+                self.worker.controlled_toggle(target, [q for q in controls if self.is_local(q)],
+                                              [q for q in zero_controls if self.is_local(q)])
+                self.store(chunk)
+
+    def diagonal_op(self, qubits, phases):
+        # the bits of global qubits pick the phases of the local ones, no swaps needed
+        phases = self.cast(phases)
+        local = [q for q in qubits if self.is_local(q)]
+        for i, chunk in self.chunks():
+            index = tuple(slice(None) if q in local else self.chunk_bit(i, q) for q in qubits)
+            if len(local) == 0:
+                chunk *= phases[index]
+                continue
+            self.load(chunk)
+            self.worker.diagonal_op(local, phases[index])
+            self.store(chunk)
+
+    def multi_controlled_Z(self, *qubits):
+        phases = np.ones((2,) * len(qubits))
+        phases[(1,) * len(qubits)] = -1
+        self.diagonal_op(qubits, phases)
+
+    reflect_uniform = QuantumComputer.reflect_by_hadamard
+
+    def toggle_where(self, target, qubits, mask):
+        self.localize([target])
+        local = [q for q in qubits if self.is_local(q)]
+        for i, chunk in self.chunks():
+            index = tuple(slice(None) if q in local else self.chunk_bit(i, q) for q in qubits)
+            if len(local) == 0 and not mask[index]:
+                continue
+            self.load(chunk)
+            if len(local) == 0:
+                self.worker.controlled_toggle(target)
+            else:
+                self.worker.toggle_where(target, local, mask[index])
+            self.store(chunk)
+
+    # Utils
+    def print_state(self):
+        # amplitudes in the order of self.qubits
+        print(np.array(self.amplitudes()))
+
+    def open(self, path, size):
+        with open(path, "a+b") as file:
+            file.truncate(size * self.dtype.itemsize)
+        return np.memmap(path, self.dtype, "r+", shape=(size,))
+
+    def resize(self, size):
+        # growing the files keeps their contents, so the state stays in place
+        if self.buffers[0].size < size:
+            self.buffers = [self.open(buffer.filename, size) for buffer in self.buffers]
+        self.state = self.buffers[0][:size]
+        self.scratch = self.buffers[1][:size]
+
+    def num_local(self):
+        return min(len(self.layout), self.chunk_qubits)
+
+    def local_qubits(self):
+        return self.layout[len(self.layout) - self.num_local():]
+
+    def is_local(self, qubit):
+        return self.axes[qubit] >= len(self.layout) - self.num_local()
+
+    def chunk_size(self):
+        return 2**self.num_local()
+
+    def chunks(self):
+        size = self.chunk_size()
+        for i in range(self.state.size // size):
+            yield i, self.state[i * size:(i + 1) * size]
+
+    def chunk_bit(self, i, qubit):
+        # value of a global qubit in chunk i
+        num_global = len(self.layout) - self.num_local()
+        return (i >> (num_global - 1 - self.axes[qubit])) & 1
+
+    def chunk_pairs(self, qubit):
+        num_global = len(self.layout) - self.num_local()
+        bit = 1 << (num_global - 1 - self.axes[qubit])
+        for i in range(self.state.size // self.chunk_size()):
+            if not i & bit:
+                yield i, i | bit
+
+    def load(self, chunk):
+        """
+        Copy a chunk into the worker, returning the probabilities of its amplitudes
+        """
+        self.worker.set_layout(self.local_qubits())
+        self.worker.resize(chunk.size)
+        np.copyto(self.worker.state, chunk)
+        return self.worker.probabilities(self.worker.state)
+
+    def store(self, chunk):
+        chunk[:] = self.worker.state
+
+    def each_chunk(self, name, qubits, *args):
+        # run the worker's gate on every chunk, after making qubits local
+        self.localize(qubits)
+        for _, chunk in self.chunks():
+            self.load(chunk)
+            getattr(self.worker, name)(*args)
+            self.store(chunk)
+
+    def localize(self, qubits):
+        """
+        Swap the global qubits among qubits with local qubits that are not, one streaming
+        pass over the chunk pairs each
+        """
+        if len(qubits) > self.chunk_qubits:
+            raise ValueError(f"a gate on {len(qubits)} qubits needs chunk_qubits >= {len(qubits)}, "
+                             f"not {self.chunk_qubits}")
+        free = [q for q in self.local_qubits() if q not in qubits]
+        for qubit in qubits:
+            if not self.is_local(qubit):
+                self.swap_global(qubit, free.pop(0))
+
+    def swap_global(self, g, l):
+        size = self.chunk_size()
+        num_global = len(self.layout) - self.num_local()
+        p = self.axes[l] - num_global
+        for i, j in self.chunk_pairs(g):
+            a = self.state[i * size:(i + 1) * size].reshape(2**p, 2, -1)
+            b = self.state[j * size:(j + 1) * size].reshape(2**p, 2, -1)
+            tmp = np.array(a[:, 1, :])
+            a[:, 1, :] = b[:, 0, :]
+            b[:, 0, :] = tmp
+        # amplitudes with (g, l) = (0, 1) and (1, 0) exchanged, so the two labels swap too
+        a, b = self.axes[g], self.axes[l]
+        self.layout[a], self.layout[b] = l, g
+        self.axes[g], self.axes[l] = b, a
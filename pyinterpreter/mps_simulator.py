@@ -0,0 +1,313 @@
+import numpy as np
+from qc_simulator import QuantumComputer
+
+# print the amplitudes while there are at most this many qubits
+MAX_PRINT_QUBITS = 20
+
+class MPSQuantumComputer:
+    """
+    Matrix product state simulator: site j of the chain holds a (left, 2, right) tensor
+    for the qubit self.layout[j], so memory grows with the entanglement instead of 2^n.
+    Single qubit gates contract into one site. Gates on k qubits first bring them next
+    to each other with swaps, contract the k sites, apply the gate and split the block
+    back with SVDs, keeping at most max_bond singular values and dropping those whose
+    weight is below cutoff. The weight dropped so far is kept in truncation_error.
+    The chain is kept in mixed canonical form around site self.center, so the dropped
+    weights are the actual errors of each truncation.
+    - max_bond: largest bond dimension, None for no limit
+    - cutoff: singular values with s^2 below this are dropped
+    - seed: seed or np.random.Generator for the measurements
+    """
+    def __init__(self, dtype=np.complex128, seed=None, max_bond=64, cutoff=1e-12) -> None:
+        self.dtype = np.dtype(dtype)
+        self.rng = np.random.default_rng(seed)
+        self.max_bond = max_bond
+        self.cutoff = cutoff
+        self.truncation_error = 0.0
+        self.qubits = []
+        self.layout = [] # qubit of each site
+        self.sites = {} # qubit -> its site in layout
+        self.tensors = []
+        self.center = 0
+
+    # Qubit creation and deletion
+    def new_qubit(self, *args):
+        for qubit in args:
+            tensor = np.zeros((1, 2, 1), self.dtype)
+            tensor[0, 0, 0] = 1
+            self.tensors.append(tensor)
+            self.sites[qubit] = len(self.layout)
+            self.layout.append(qubit)
+            self.qubits.append(qubit)
+
+    def extract(self, *args):
+        if len(args) == 0: # extract all
+            args = list(self.qubits)
+        output = ""
+        for qubit in args:
+            site = self.sites.pop(qubit)
+            self.move_center(site)
+            tensor = self.tensors[site]
+            probs = np.sum(np.abs(tensor)**2, axis=(0, 2))
+            bit = int(self.rng.random() * np.sum(probs) >= probs[0])
+            matrix = tensor[:, bit, :] / np.sqrt(probs[bit])
+            # fold the measured site into a neighbour, which becomes the center
+            del self.tensors[site], self.layout[site]
+            for later in range(site, len(self.layout)):
+                self.sites[self.layout[later]] = later
+            if site < len(self.tensors):
+                self.tensors[site] = np.einsum("lm,mbr->lbr", matrix, self.tensors[site])
+                self.center = site
+            elif site > 0:
+                self.tensors[site - 1] = np.einsum("lbm,mr->lbr", self.tensors[site - 1], matrix)
+                self.center = site - 1
+            else:
+                self.center = 0
+            self.qubits = [q for q in self.qubits if q in self.sites]
+            output += str(bit)
+        return output
+
+    def sample(self, shots, qubits=None):
+        """
+        Measure qubits (all qubits if None) shots times without collapsing the state.
+        Sweeps the chain once for all shots from the left end, in right canonical form:
+        each shot carries its left environment as a vector, and the probabilities of a
+        site's bits are the norms of that vector contracted with the site. Sites past the
+        last requested one are marginalized by the canonical form, earlier ones not
+        requested are drawn like the others and left out of the outcome
+        """
+        if qubits is None:
+            qubits = self.qubits
+        self.move_center(0)
+        columns = {q: j for j, q in enumerate(qubits)}
+        bits = np.zeros((shots, len(qubits)), int)
+        last = max((self.sites[q] for q in qubits), default=-1)
+        shot = np.arange(shots)
+        left = np.ones((shots, 1), self.dtype)
+        for qubit, tensor in zip(self.layout[:last + 1], self.tensors):
+            branches = np.tensordot(left, tensor, axes=(1, 0)) # (shots, 2, right)
+            probs = np.sum(np.abs(branches)**2, axis=2)
+            bit = (self.rng.random(shots) * probs.sum(axis=1) >= probs[:, 0]).astype(int)
+            left = branches[shot, bit] / np.sqrt(probs[shot, bit])[:, None]
+            if qubit in columns:
+                bits[:, columns[qubit]] = bit
+        outcomes, counts = np.unique(bits, axis=0, return_counts=True)
+        return {"".join(map(str, outcome)): int(count) for outcome, count in zip(outcomes, counts)}
+
+    # Gates
+    def hadamard(self, *qubits):
+        if len(qubits) == 0:
+            qubits = self.qubits
+        hadamard = np.array([[1, 1], [1, -1]]) / np.sqrt(2)
+        for qubit in qubits:
+            self.single_qubit_op(qubit, hadamard)
+
+    def pauli_X(self, qubit):
+        self.toggle(qubit)
+
+    def toggle(self, qubit):
+        self.single_qubit_op(qubit, np.array([[0, 1], [1, 0]]))
+
+    def NOT(self, qubit):
+        self.toggle(qubit)
+
+    def rotate(self, qubit, angle):
+        sin = np.sin(angle / 180 * np.pi)
+        cos = np.cos(angle / 180 * np.pi)
+        self.single_qubit_op(qubit, np.array([[cos, -sin], [sin, cos]]))
+
+    def single_qubit_op(self, qubit, op):
+        site = self.sites[qubit]
+        self.tensors[site] = np.einsum("ab,lbr->lar", self.cast(op), self.tensors[site])
+
+    def multi_qubit_op(self, qubits, op):
+        """
+        Apply a 2^k x 2^k operator to k qubits, the first qubit being the most significant bit
+        """
+        k = len(qubits)
+        start = self.gather(qubits)
+        # reorder op's qubit axes from the order of qubits to the order of the sites
+        order = sorted(range(k), key=lambda j: self.sites[qubits[j]])
+        op = self.cast(op).reshape((2,) * 2 * k).transpose(order + [k + j for j in order])
+        self.move_center(start)
+        theta = self.tensors[start]
+        for site in range(start + 1, start + k):
+            theta = np.tensordot(theta, self.tensors[site], axes=(-1, 0))
+        theta = np.tensordot(op.reshape((2,) * 2 * k), theta, axes=(list(range(k, 2 * k)), list(range(1, k + 1))))
+        theta = np.moveaxis(theta, k, 0) # (left, 2, ..., 2, right)
+        self.split(theta, start)
+
+    def CNOT(self, A, B):
+        self.controlled_toggle(B, [A])
+
+    def if_A_then_toggle_B(self, A, B):
+        self.CNOT(A, B)
+
+    def CCNOT(self, A, B, C):
+        self.controlled_toggle(C, [A, B])
+
+    def if_A_and_B_then_toggle_C(self, A, B, C):
+        self.CCNOT(A, B, C)
+
+    def if_A_or_B_then_toggle_C(self, A, B, C):
+        # A OR B == NOT (NOT A AND NOT B)
+        self.toggle(C)
+        self.controlled_toggle(C, zero_controls=[A, B])
+
+    def if_not_A_then_toggle_B(self, A, B):
+        self.controlled_toggle(B, zero_controls=[A])
+
+    def swap(self, A, B):
+        # relabel the sites instead of moving tensors
+        a, b = self.sites[A], self.sites[B]
+        self.layout[a], self.layout[b] = B, A
+        self.sites[A], self.sites[B] = b, a
+
+    def controlled_toggle(self, target, controls=(), zero_controls=()):
+        mask = np.zeros((2,) * (len(controls) + len(zero_controls)), bool)
+        mask[(1,) * len(controls) + (0,) * len(zero_controls)] = True
+        self.toggle_where(target, [*controls, *zero_controls], mask)
+
+    def toggle_where(self, target, qubits, mask):
+        # the permutation matrix over (target, *qubits) that flips target where mask is True
+        k = len(qubits) + 1
+        index = np.arange(2**k)
+        flip = np.asarray(mask).reshape(-1)[index & (2**(k - 1) - 1)]
+        op = np.zeros((2**k, 2**k))
+        op[index ^ (flip.astype(int) << (k - 1)), index] = 1
+        self.multi_qubit_op([target, *qubits], op)
+
+    def diagonal_op(self, qubits, phases):
+        if len(qubits) == 1:
+            self.single_qubit_op(qubits[0], np.diag(np.asarray(phases).reshape(-1)))
+        else:
+            self.multi_qubit_op(qubits, np.diag(np.asarray(phases).reshape(-1)))
+
+    # Phases
+    def apply_phase(self, values, qubits=None):
+        if qubits is None:
+            qubits = self.qubits
+        values = np.asarray(values)
+        if values.dtype == bool:
+            values = np.where(values, -1, 1)
+        self.diagonal_op(qubits, values)
+
+    def phase(self, qubit, angle):
+        cos = np.cos(angle / 180 * np.pi)
+        sin = np.sin(angle / 180 * np.pi)
+        self.diagonal_op([qubit], np.array([1, cos if np.isclose(sin, 0) else cos + 1j * sin]))
+
+    def if_A_then_minus(self, A):
+        self.multi_controlled_Z(A)
+
+    def controlled_Z(self, A, B):
+        self.multi_controlled_Z(A, B)
+
+    def multi_controlled_Z(self, *qubits):
+        phases = np.ones(2**len(qubits))
+        phases[-1] = -1
+        self.diagonal_op(qubits, phases)
+
+    reflect_uniform = QuantumComputer.reflect_by_hadamard
+
+    # Classical functions, applied from the truth table of the CCode
+    def toggle_f_onto_Cs(self, ccode, *args):
+        table = ccode.truth_table()
+        n = len(ccode.arguments)
+        assert len(args) == n + table.shape[-1]
+        for j, C in enumerate(args[n:]):
+            self.toggle_where(C, args[:n], table[..., j])
+
+    def if_f_then_minus(self, ccode, *args):
+        self.apply_phase(ccode.signs(), args)
+
+    # Utils
+    def print_state(self):
+        if len(self.qubits) > MAX_PRINT_QUBITS:
+            print(f"MPS over {len(self.qubits)} qubits, bond dimensions {self.bond_dimensions()}")
+            return
+        state = np.ones((1, 1), self.dtype)
+        for tensor in self.tensors:
+            state = np.tensordot(state, tensor, axes=(-1, 0)).reshape(-1, tensor.shape[-1])
+        n = len(self.qubits)
+        order = [self.sites[q] for q in self.qubits]
+        print(state.reshape((2,) * n).transpose(order).reshape(-1) if n > 0 else state.reshape(-1))
+
+    def state_size(self):
+        # entries of the tensors
+        return sum(tensor.size for tensor in self.tensors)
+
+    def bond_dimensions(self):
+        return [tensor.shape[-1] for tensor in self.tensors[:-1]]
+
+    def cast(self, values):
+        values = np.asarray(values)
+        if np.iscomplexobj(values) and self.dtype.kind != "c":
+            raise ValueError(f"complex gate on a {self.dtype} state")
+        return values.astype(self.dtype, copy=False)
+
+    def move_center(self, site):
+        # QR sweeps so that every tensor left of site is left-orthonormal and every
+        # tensor right of it right-orthonormal
+        while self.center < site:
+            tensor = self.tensors[self.center]
+            l, _, r = tensor.shape
+            q, rest = np.linalg.qr(tensor.reshape(l * 2, r))
+            self.tensors[self.center] = q.reshape(l, 2, -1)
+            self.tensors[self.center + 1] = np.tensordot(rest, self.tensors[self.center + 1], axes=(1, 0))
+            self.center += 1
+        while self.center > site:
+            tensor = self.tensors[self.center]
+            l, _, r = tensor.shape
+            q, rest = np.linalg.qr(tensor.reshape(l, 2 * r).T)
+            self.tensors[self.center] = q.T.reshape(-1, 2, r)
+            self.tensors[self.center - 1] = np.tensordot(self.tensors[self.center - 1], rest.T, axes=(-1, 0))
+            self.center -= 1
+
+    def gather(self, qubits):
+        """
+        Swap sites until qubits sit on consecutive sites. Returns the first of them
+        """
+        sites = sorted(self.sites[q] for q in qubits)
+        start = sites[0]
+        for m, site in enumerate(sites[1:], 1):
+            while site > start + m:
+                self.swap_sites(site - 1)
+                site -= 1
+        return start
+
+    def swap_sites(self, site):
+        # exchange the qubits on site and site + 1, moving the amplitudes with them
+        self.move_center(site)
+        theta = np.tensordot(self.tensors[site], self.tensors[site + 1], axes=(-1, 0))
+        self.split(theta.transpose(0, 2, 1, 3), site)
+        a, b = self.layout[site], self.layout[site + 1]
+        self.layout[site], self.layout[site + 1] = b, a
+        self.sites[a], self.sites[b] = site + 1, site
+
+    def split(self, theta, start):
+        """
+        Split a (left, 2, ..., 2, right) block back into sites start, start + 1, ... with
+        truncated SVDs from left to right, leaving the center on the last site
+        """
+        k = theta.ndim - 2
+        for site in range(start, start + k - 1):
+            left = theta.shape[0]
+            u, s, vh = np.linalg.svd(theta.reshape(left * 2, -1), full_matrices=False)
+            keep = self.bond(s)
+            norm = np.linalg.norm(s[:keep])
+            self.tensors[site] = u[:, :keep].reshape(left, 2, keep)
+            theta = ((s[:keep] / norm)[:, None] * vh[:keep]).reshape((keep,) + theta.shape[2:])
+        self.tensors[start + k - 1] = theta
+        self.center = start + k - 1
+
+    def bond(self, s):
+        """
+        Number of singular values to keep, adding the weight of the others to truncation_error
+        """
+        weights = s**2 / np.sum(s**2)
+        keep = max(1, int(np.sum(weights > self.cutoff)))
+        if self.max_bond is not None:
+            keep = min(keep, self.max_bond)
+        self.truncation_error += float(np.sum(weights[keep:]))
+        return keep
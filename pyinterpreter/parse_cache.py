@@ -0,0 +1,54 @@
+import os
+import pickle
+
+# path -> (key, parsed), shared by the whole process
+cache = {}
+code_version = None
+
+def get_code_version():
+    """
+    Latest mtime of the modules next to this one, so that changes to the parsers
+    invalidate the pickles written by older versions
+    """
+    global code_version
+    if code_version is None:
+        folder = os.path.dirname(os.path.abspath(__file__))
+        code_version = max(os.stat(os.path.join(folder, f)).st_mtime_ns
+                           for f in os.listdir(folder) if f.endswith(".py"))
+    return code_version
+
+def load(file_name, parser):
+    """
+    Return parser(file_name), reusing an earlier result while the file is unchanged.
+    Results are keyed on (path, mtime, size), kept for the lifetime of the process and
+    pickled into __pycache__ next to the file so the next run can skip parsing too
+    """
+    path = os.path.abspath(file_name)
+    stat = os.stat(path)
+    tag = f"{parser.__module__}.{parser.__qualname__}"
+    key = (tag, stat.st_mtime_ns, stat.st_size, get_code_version())
+    if path in cache and cache[path][0] == key:
+        return cache[path][1]
+
+    folder = os.path.join(os.path.dirname(path), "__pycache__")
+    pickle_name = os.path.join(folder, f"{os.path.basename(path)}.{tag}.pickle")
+    parsed = None
+    try:
+        with open(pickle_name, "rb") as file:
+            saved_key, saved = pickle.load(file)
+        if saved_key == key:
+            parsed = saved
+    except Exception: # missing, stale or unreadable cache file
+        pass
+
+    if parsed is None:
+        parsed = parser(file_name)
+        try:
+            os.makedirs(folder, exist_ok=True)
+            with open(pickle_name, "wb") as file:
+                pickle.dump((key, parsed), file)
+        except (OSError, pickle.PicklingError):
+            pass
+
+    cache[path] = (key, parsed)
+    return parsed
@@ -0,0 +1,127 @@
+import time
+import tracemalloc
+
+# simulator methods timed by attach. Methods a gate calls on its own computer
+# (e.g. toggle calling controlled_toggle) show up nested under it
+GATES = [
+    "new_qubit", "extract", "sample", "hadamard", "pauli_X", "toggle", "NOT", "rotate", "single_qubit_op",
+    "multi_qubit_op", "CNOT", "if_A_then_toggle_B", "CCNOT", "if_A_and_B_then_toggle_C", "if_A_or_B_then_toggle_C",
+    "if_not_A_then_toggle_B", "swap", "controlled_toggle", "diagonal_op", "toggle_where", "apply_phase", "phase",
+    "if_A_then_minus", "controlled_Z", "multi_controlled_Z", "reflect_uniform", "toggle_f_onto_Cs",
+    "if_f_then_minus", "print_state",
+]
+
+class Profiler:
+    """
+    Opt-in instrumentation of the interpreter and its simulators. Each record is keyed
+    by its stack: the labels of the interpreted instructions ("file:line code: command")
+    and gates it runs inside, outermost first, so a gate is charged to the call chain and
+    source line that ran it. Nothing is wrapped unless a Profiler is given, so a run
+    without one costs nothing extra.
+    - memory: also record the bytes allocated at the peak of each record with tracemalloc
+      (started here until close), which slows down the Python parts of a run
+    """
+    def __init__(self, memory=True) -> None:
+        self.memory = memory
+        # stack -> [count, time, self time, largest state size, largest allocation]
+        self.stats = {}
+        self.stack = [] # labels of the records in progress
+        self.open = [] # [start time, time of finished children, start memory, peak memory] of each
+        self.tracing = memory and not tracemalloc.is_tracing() # whether close stops tracemalloc
+        if self.tracing:
+            tracemalloc.start()
+
+    def close(self):
+        """
+        Stop the tracemalloc tracing started here. The records are kept, later ones
+        have no allocation
+        """
+        self.memory = False
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    # Recording
+    def attach(self, qc):
+        """
+        Time the gates of simulator qc by shadowing its methods with wrappers
+        """
+        for name in GATES:
+            if hasattr(qc, name):
+                setattr(qc, name, self.wrap(getattr(qc, name), name, qc))
+
+    def wrap(self, func, label, qc):
+        def wrapper(*args, **kwargs):
+            self.enter(label)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.exit(qc)
+        return wrapper
+
+    def enter(self, label):
+        memory = 0
+        if self.memory:
+            memory, peak = tracemalloc.get_traced_memory()
+            if len(self.open) > 0:
+                self.open[-1][3] = max(self.open[-1][3], peak)
+            tracemalloc.reset_peak()
+        self.stack.append(label)
+        self.open.append([time.perf_counter(), 0.0, memory, memory])
+
+    def exit(self, qc):
+        """
+        Close the innermost record, taking the state size from qc
+        """
+        start, children, memory, peak = self.open.pop()
+        elapsed = time.perf_counter() - start
+        if self.memory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        if len(self.open) > 0:
+            self.open[-1][1] += elapsed
+            self.open[-1][3] = max(self.open[-1][3], peak)
+
+        key = tuple(self.stack)
+        self.stack.pop()
+        stats = self.stats.setdefault(key, [0, 0.0, 0.0, 0, 0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] += elapsed - children
+        stats[3] = max(stats[3], qc.state_size())
+        stats[4] = max(stats[4], peak - memory)
+
+    # Output
+    def collapsed(self):
+        """
+        Lines "label;label;... microseconds" of self time per stack, the input of
+        flamegraph.pl and speedscope
+        """
+        return [";".join(stack) + f" {round(stats[2] * 1e6)}" for stack, stats in self.stats.items()
+                if round(stats[2] * 1e6) > 0]
+
+    def write_collapsed(self, file_name):
+        with open(file_name, "w") as file:
+            file.write("\n".join(self.collapsed()) + "\n")
+
+    def summary(self):
+        """
+        Records merged by label (source line or gate), most time first, as
+        [label, count, time, self time, largest state size, largest allocation]. The time
+        of a label that appears inside itself is counted once
+        """
+        rows = {}
+        for stack, (count, total, own, size, allocated) in self.stats.items():
+            row = rows.setdefault(stack[-1], [stack[-1], 0, 0.0, 0.0, 0, 0])
+            row[1] += count
+            if stack[-1] not in stack[:-1]:
+                row[2] += total
+            row[3] += own
+            row[4] = max(row[4], size)
+            row[5] = max(row[5], allocated)
+        return sorted(rows.values(), key=lambda row: -row[2])
+
+    def print_summary(self, limit=30):
+        print(f"{'count':>8} {'time (s)':>10} {'self (s)':>10} {'state size':>11} {'alloc (B)':>11}  where")
+        for label, count, total, own, size, allocated in self.summary()[:limit]:
+            print(f"{count:>8} {total:>10.4f} {own:>10.4f} {size:>11} {allocated:>11}  {label}")
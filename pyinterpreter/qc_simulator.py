@@ -1,92 +1,130 @@
 import numpy as np
-import random
+from concurrent.futures import ThreadPoolExecutor
+
+# gates on fewer amplitudes than this run on one thread even with threads set
+MIN_PARALLEL_SIZE = 2**14
 
 class QuantumComputer:
-    def __init__(self) -> None:
-        self.qubits = []
-        self.state = np.ones(1)
+    """
+    - dtype: precision of the amplitudes. complex128 by default; complex64 halves the
+      memory, float32 quarters it but can only hold real amplitudes
+    - threads: if set, single qubit ops and controlled toggles split the state into
+      disjoint blocks and run them on a pool of this many threads (numpy releases the
+      GIL inside its loops)
+    - seed: seed or np.random.Generator for the measurements
+    New qubits are not added to the state vector right away: while only classical gates
+    (toggles, controlled toggles with classical controls, phases) touch them their value
+    is a known bit kept in self.known. They get an axis of the state the first time a
+    gate could entangle them, so ancillas that stay classical cost nothing.
+    """
+    def __init__(self, dtype=np.complex128, threads=None, seed=None) -> None:
+        self.dtype = np.dtype(dtype)
+        self.rng = np.random.default_rng(seed)
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(threads) if threads else None
+        self.qubits = [] # in the order outcomes and amplitudes are reported
+        self.layout = [] # qubit of each axis of the state, the first being the most significant bit
+        self.axes = {} # qubit -> its position in layout
+        self.known = {} # qubit -> its bit, for qubits not in layout
+        # two preallocated amplitude buffers: state is the front one and gates that can't
+        # run in place write the new amplitudes into scratch, then the two are flipped
+        self.buffers = [np.ones(1, self.dtype), np.zeros(1, self.dtype)]
+        self.state, self.scratch = self.buffers
 
     # Qubit creation and deletion
     def new_qubit(self, *args):
-        for qubit in args:
-            self.qubits.append(qubit)
-            self.state = np.kron(self.state, np.array([1.0, 0.0]))
+        # |0> qubits stay out of the state until materialize
+        self.qubits.extend(args)
+        self.known.update(dict.fromkeys(args, 0))
  
     def extract(self, *args):
         if len(args) == 0: # extract all
-            probs = self.state * self.state 
-            r = random.random()
-            cum_prob = 0
-            for i in range(probs.shape[0]):
-                p = probs[i]
-                if cum_prob <= r < cum_prob + p:
-                    output = self.index_to_basic_state(i)
-                    #print(f"Measurement of {''.join(self.qubits)}: {output}")
-                    break
-                cum_prob += p
-
-            self.qubits = []
-            self.state = np.ones(1)
+            i = 0 # only known qubits
+            if len(self.layout) > 0:
+                i = self.choose(self.probabilities(self.state), overwrite=True)
+            output = self.layout_to_basic_state(i)
+            #print(f"Measurement of {''.join(self.qubits)}: {output}")
+
+            self.set_layout([])
+            self.buffers[0][0] = 1
+            self.resize(1)
             return output
-        output = "" 
-        for qubit in args:
-            probs = self.state * self.state 
-            r = random.random()
-            i = self.qubits.index(qubit)
-            res_0, res_1 = 0.0, 0.0
-            for j in range(len(self.state)):
-                basic = self.index_to_basic_state(j)
-                if basic[i] == "0": res_0 += probs[j]
-                else: res_1 += probs[j]
-            final = r < res_0 # measurement is 0
-
-            new_state = np.zeros(len(self.state)//2)
-            index = 0
-            # conidition on measurement
-            for j in range(len(self.state)):
-                basic = self.index_to_basic_state(j)
-                if (basic[i] == "0" and final) or (basic[i] == "1" and not final):
-                    new_state[index] = self.state[j]
-                    index += 1
-            # normalize
-            factor = np.math.sqrt(np.sum(new_state * new_state))
-            new_state /= factor
-            self.state = new_state
-            self.qubits.remove(qubit)
-
-            #if final: print(f"Measurement of {qubit}: 0")
-            #else: print(f"Measurement of {qubit}: 1")
-            output += ("0" if final else "1")
-
-        return output
+
+        # known qubits are read off, only the others are measured
+        dense = [q for q in args if q not in self.known]
+        bits = {q: str(self.known[q]) for q in args if q in self.known}
+        if len(dense) > 0:
+            tensor, axes, marginal = self.marginal(*dense)
+            outcome = self.choose(marginal)
+            bits.update(zip(dense, self.index_to_basic_state(outcome, len(dense))))
+
+            # condition on measurement
+            index = [slice(None)] * tensor.ndim
+            for q, axis in zip(dense, axes):
+                index[axis] = int(bits[q])
+            kept = tensor[tuple(index)]
+            np.divide(kept, np.sqrt(marginal[outcome]), out=self.temp(kept.shape))
+            self.flip()
+            self.resize(kept.size)
+        self.remove_qubits(args)
+
+        return "".join(bits[q] for q in args)
+
+    def sample(self, shots, qubits=None):
+        """
+        Measure qubits (all qubits if None) shots times without collapsing the state.
+        Returns a histogram of the outcomes
+        """
+        if qubits is None:
+            qubits = self.qubits
+        dense = [q for q in qubits if q not in self.known]
+        _, _, marginal = self.marginal(*dense)
+        counts = self.rng.multinomial(shots, marginal / np.sum(marginal))
+        histogram = {}
+        for i in np.flatnonzero(counts):
+            bits = dict(zip(dense, self.index_to_basic_state(i, len(dense))))
+            histogram["".join(bits[q] if q in bits else str(self.known[q]) for q in qubits)] = int(counts[i])
+        return histogram
 
     # Hadamard    
     def hadamard(self, *qubits):
         if len(qubits) == 0:
             qubits = self.qubits
+        self.walsh_hadamard(qubits)
+
+    def walsh_hadamard(self, qubits):
+        """
+        Hadamard on each of qubits as a fast Walsh-Hadamard transform: one add/subtract
+        butterfly pass per qubit into scratch, then a single 2^(-k/2) rescale. O(k 2^n)
+        without building any matrix or multiplying by 1/sqrt(2) at every step
+        """
+        if len(qubits) == 0:
+            return
+        self.materialize(qubits)
         for qubit in qubits:
-            self.hadamard_single(qubit)
+            tensor, (axis,) = self.tensor(qubit)
+            tensor = tensor.reshape(int(np.prod(tensor.shape[:axis])), 2, -1)
+            out = self.temp(tensor.shape)
+
+            def butterfly(b, tensor=tensor, out=out):
+                t, o = tensor[b], out[b]
+                np.add(t[:, 0], t[:, 1], out=o[:, 0])
+                np.subtract(t[:, 0], t[:, 1], out=o[:, 1])
+            self.in_blocks(butterfly, tensor.shape, (0, 2))
+            self.flip()
+        scale = self.cast(2 ** (-len(qubits) / 2))
+        self.in_blocks(lambda b: np.multiply(self.state[b], scale, out=self.state[b]), self.state.shape, (0,))
 
     def hadamard_single(self, qubit):
-        n = len(self.qubits)
-        i = n - 1 - self.qubits.index(qubit)
-        d = 1 << i
-        new_state = np.zeros_like(self.state)
-        for j in range(2**(n-1)):
-            index = ((j >> i) << (i + 1)) + (j % d)
-            a, b = self.state[index], self.state[index + d]
-            new_state[index], new_state[index + d] = a + b, a - b
-        self.state = new_state / np.math.sqrt(2)
+        hadamard = np.array([[1, 1], [1, -1]]) / np.sqrt(2)
+        self.single_qubit_op(qubit, hadamard)
 
     def hadamard_all_matrix(self):
-        hadamard = np.array([[1, 1], [1, -1]]) / np.math.sqrt(2)
-        matrix = hadamard
-        for _ in range(1, len(self.qubits)):
-            matrix = np.kron(matrix, hadamard)
-        self.state = matrix @ self.state
+        # the 2^n x 2^n matrix H x ... x H is the Walsh-Hadamard transform, never build it
+        self.walsh_hadamard(self.qubits)
 
     def hadamard_single_matrix(self, qubit):
-        hadamard = np.array([[1, 1], [1, -1]]) / np.math.sqrt(2)
+        hadamard = np.array([[1, 1], [1, -1]]) / np.sqrt(2)
         self.single_qubit_op(qubit, hadamard)
 
     ### Classical Reversible ###
@@ -98,108 +136,434 @@ class QuantumComputer:
         self.NOT(qubit)
 
     def NOT(self, qubit):
-        i = self.qubits.index(qubit)
-        new_state = np.zeros_like(self.state)
-        for j in range(len(self.state)):
-            n = len(self.qubits)
-            bit = ((j >> (n - 1 - i)) % 2)
-            add = 1 << (n - 1 - i)
-            k = j + (add if bit == 0 else -add)
-            new_state[j] = self.state[k]
-        self.state = new_state
+        self.controlled_toggle(qubit)
 
     def rotate(self, qubit, angle):
-        sin = np.math.sin(angle / 180 * np.math.pi)
-        cos = np.math.cos(angle / 180 * np.math.pi)
+        sin = np.sin(angle / 180 * np.pi)
+        cos = np.cos(angle / 180 * np.pi)
         rotation = np.array([[cos, -sin], [sin, cos]])
         self.single_qubit_op(qubit, rotation)   
 
     def single_qubit_op(self, qubit, op):
-        identity = np.array([[1, 0], [0, 1]])
-        matrix = None
-        for q in self.qubits:
-            if q == qubit:
-                if matrix is None:
-                    matrix = op 
-                else:
-                    matrix = np.kron(matrix, op)
-            else:
-                if matrix is None:
-                    matrix = identity
-                else:
-                    matrix = np.kron(matrix, identity)
-        self.state = matrix @ self.state
+        # apply op along the qubit's axis only, O(2^n) instead of a 2^n x 2^n matrix
+        if qubit in self.known:
+            column = self.cast(op)[:, self.known[qubit]]
+            if np.count_nonzero(column) == 1: # a basis state to a basis state, e.g. a toggle
+                self.known[qubit] = int(np.flatnonzero(column)[0])
+                self.global_phase(column[self.known[qubit]])
+                return
+            self.materialize([qubit])
+        tensor, (axis,) = self.tensor(qubit)
+        tensor = tensor.reshape(int(np.prod(tensor.shape[:axis])), 2, -1)
+        op, out = self.cast(op), self.temp(tensor.shape)
+        self.in_blocks(lambda b: np.einsum("ab,ibj->iaj", op, tensor[b], out=out[b]), tensor.shape, (0, 2))
+        self.flip()
+
+    def multi_qubit_op(self, qubits, op):
+        """
+        Apply a 2^k x 2^k operator to k qubits, the first qubit being the most significant bit
+        """
+        k = len(qubits)
+        self.materialize(qubits)
+        tensor, axes = self.tensor(*qubits)
+        op = self.cast(op).reshape((2,) * 2 * k)
+        result = np.tensordot(op, tensor, axes=(list(range(k, 2 * k)), axes))
+        # tensordot puts the qubit axes first, move them back in place
+        np.copyto(self.temp(tensor.shape), np.moveaxis(result, list(range(k)), axes))
+        self.flip()
 
     # Multi-qubit operations
     def CNOT(self, A, B):
-        i1, i2 = self.qubits.index(A), self.qubits.index(B)
-        new_state = np.zeros_like(self.state)
-        for i in range(len(self.state)):
-            basic = self.index_to_basic_state(i)
-            if basic[i1] == "1":
-                target = basic[:i2] + ("1" if basic[i2] == "0" else "0") + basic[i2+1:]
-                new_state[i] = self.state[self.basic_state_to_index(target)]
-            else:
-                new_state[i] = self.state[i]
-        self.state = new_state
+        self.controlled_toggle(B, [A])
 
     def if_A_then_toggle_B(self, A, B):
         self.CNOT(A, B)
         
     def CCNOT(self, A, B, C):
-        i1, i2, i3 = self.qubits.index(A), self.qubits.index(B), self.qubits.index(C)
-        new_state = np.zeros_like(self.state)
-        for i in range(len(self.state)):
-            basic = self.index_to_basic_state(i)
-            if basic[i1] == "1" and basic[i2] == "1":
-                target = basic[:i3] + ("1" if basic[i3] == "0" else "0") + basic[i3+1:]
-                new_state[i] = self.state[self.basic_state_to_index(target)]
-            else:
-                new_state[i] = self.state[i]
-        self.state = new_state
+        self.controlled_toggle(C, [A, B])
     
     def if_A_and_B_then_toggle_C(self, A, B, C):
         self.CCNOT(A, B, C)
 
     # Extra functions
     def swap(self, A, B):
-        i1, i2 = self.qubits.index(A), self.qubits.index(B)
-        new_state = np.zeros_like(self.state)
-        for i in range(len(self.state)):
-            basic = self.index_to_basic_state(i)
-            target = basic
-            target[i1] = basic[i2]
-            target[i2] = basic[i1]
-            new_state[i] = self.state[self.basic_state_to_index(target)]
-        self.state = new_state
+        # relabel the axes (and known bits) instead of moving amplitudes
+        if A in self.known and B in self.known:
+            self.known[A], self.known[B] = self.known[B], self.known[A]
+            return
+        if A in self.known:
+            A, B = B, A
+        if B in self.known: # B takes A's axis, A B's bit
+            self.known[A] = self.known.pop(B)
+            self.axes[B] = self.axes.pop(A)
+            self.layout[self.axes[B]] = B
+            return
+        a, b = self.axes[A], self.axes[B]
+        self.layout[a], self.layout[b] = B, A
+        self.axes[A], self.axes[B] = b, a
     
     def if_A_or_B_then_toggle_C(self, A, B, C):
-        self.toggle(A)
-        self.toggle(B)
-        self.if_A_and_B_then_toggle_C(A, B, C)
+        # A OR B == NOT (NOT A AND NOT B)
         self.toggle(C)
-        self.toggle(B)
-        self.toggle(A)
+        self.controlled_toggle(C, zero_controls=[A, B])
 
     def if_not_A_then_toggle_B(self, A, B):
-        self.toggle(A)
-        self.if_A_then_toggle_B(A, B)
-        self.toggle(A)
+        self.controlled_toggle(B, zero_controls=[A])
+
+    def controlled_toggle(self, target, controls=(), zero_controls=()):
+        """
+        Toggle target on the basis states where all controls are 1 and all zero_controls are 0.
+        Swaps the two target slices of the state in place, no per-amplitude work
+        """
+        # known controls either turn the gate off or drop out of it
+        if any(self.known.get(q) == 0 for q in controls) or any(self.known.get(q) == 1 for q in zero_controls):
+            return
+        controls = [q for q in controls if q not in self.known]
+        zero_controls = [q for q in zero_controls if q not in self.known]
+        if target in self.known and len(controls) + len(zero_controls) == 0:
+            self.known[target] ^= 1
+            return
+        self.materialize([target])
+        tensor, axes = self.tensor(target, *controls, *zero_controls)
+        index = [slice(None)] * tensor.ndim
+        for axis in axes[1:len(controls) + 1]:
+            index[axis] = 1
+        for axis in axes[len(controls) + 1:]:
+            index[axis] = 0
+        index[axes[0]] = 0
+        zero = tuple(index)
+        index[axes[0]] = 1
+        one = tuple(index)
+        self.exchange(tensor, zero, one)
+    
+    def diagonal_op(self, qubits, phases):
+        """
+        Multiply every basis state by phases[b1, ..., bk] where b1..bk are the values of qubits
+        """
+        phases, qubits = self.fix_known(self.cast(phases), qubits)
+        if len(qubits) == 0:
+            self.global_phase(phases)
+            return
+        tensor, axes = self.tensor(*qubits)
+        tensor *= self.broadcast(phases, axes, tensor.ndim)
+
+    def toggle_where(self, target, qubits, mask):
+        """
+        Toggle target on the basis states where mask[b1, ..., bk] is True, b1..bk being
+        the values of qubits (which must not include target)
+        """
+        mask, qubits = self.fix_known(np.asarray(mask), qubits)
+        if len(qubits) == 0:
+            if mask:
+                self.controlled_toggle(target)
+            return
+        self.materialize([target])
+        tensor, axes = self.tensor(target, *qubits)
+        mask = np.take(self.broadcast(mask, axes[1:], tensor.ndim), 0, axis=axes[0])
+        index = [slice(None)] * tensor.ndim
+        index[axes[0]] = 0
+        zero = tuple(index)
+        index[axes[0]] = 1
+        self.exchange(tensor, zero, tuple(index), mask)
+
+    # Phases
+    def apply_phase(self, values, qubits=None):
+        """
+        Multiply the amplitudes by values indexed by the bits of qubits (all qubits by
+        default): 2^k phases, or a boolean mask that is -1 where True
+        """
+        if qubits is None:
+            qubits = self.qubits
+        values = np.asarray(values)
+        if values.dtype == bool:
+            values = np.where(values, -1, 1)
+        self.diagonal_op(qubits, values.reshape((2,) * len(qubits)))
+
+    def phase(self, qubit, angle):
+        # multiply the amplitudes where qubit is 1 by e^(i angle), angle in degrees like rotate
+        cos = np.cos(angle / 180 * np.pi)
+        sin = np.sin(angle / 180 * np.pi)
+        self.diagonal_op([qubit], np.array([1, cos if np.isclose(sin, 0) else cos + 1j * sin]))
+
+    def if_A_then_minus(self, A):
+        self.multi_controlled_Z(A)
+
+    def controlled_Z(self, A, B):
+        self.multi_controlled_Z(A, B)
+
+    def multi_controlled_Z(self, *qubits):
+        """
+        Negate the amplitudes where all qubits are 1, touching only those
+        """
+        if any(self.known.get(q) == 0 for q in qubits):
+            return
+        qubits = [q for q in qubits if q not in self.known]
+        if len(qubits) == 0:
+            self.global_phase(-1)
+            return
+        tensor, axes = self.tensor(*qubits)
+        index = [slice(None)] * tensor.ndim
+        for axis in axes:
+            index[axis] = 1
+        ones = tensor[tuple(index) + (Ellipsis,)]
+        self.in_blocks(lambda b: np.negative(ones[b], out=ones[b]), ones.shape, range(ones.ndim))
+
+    def reflect_uniform(self, qubits):
+        """
+        2|s><s| - I on qubits, |s> being their uniform superposition: each amplitude
+        becomes twice the mean over qubits minus itself. One reduction and one pass,
+        the Grover diffusion without its Hadamards
+        """
+        self.materialize(qubits)
+        tensor, axes = self.tensor(*qubits)
+        mean = np.mean(tensor, axis=tuple(axes), keepdims=True)
+        mean *= 2
+        np.subtract(mean, tensor, out=tensor)
+
+    def reflect_by_hadamard(self, qubits):
+        """
+        reflect_uniform from gates: H, -1 on every basis state but |0...0>, H. For the
+        backends without a closed form, which only need hadamard and apply_phase
+        """
+        mask = np.ones((2,) * len(qubits), bool)
+        mask[(0,) * len(qubits)] = False
+        self.hadamard(*qubits)
+        self.apply_phase(mask, qubits)
+        self.hadamard(*qubits)
+
+    # Classical functions, applied from the truth table of the CCode
+    def toggle_f_onto_Cs(self, ccode, *args):
+        table = ccode.truth_table()
+        n = len(ccode.arguments)
+        assert len(args) == n + table.shape[-1]
+        for j, C in enumerate(args[n:]):
+            self.toggle_where(C, args[:n], table[..., j])
+
+    def if_f_then_minus(self, ccode, *args):
+        self.apply_phase(ccode.signs(), args)
     
     # Utils
     def print_state(self):
-        print(self.state)
-
-    def index_to_basic_state(self, index):
-        state = ""
-        for _ in range(len(self.qubits)):
-            if index % 2 == 0:
-                state = "0" + state
-            else:
-                state = "1" + state
-            index = index // 2
-        return state
+        print(self.amplitudes())
+
+    def amplitudes(self):
+        """
+        The state with the first qubit of self.qubits as the most significant bit. The
+        state itself when the layout is in that order, else a reordered copy
+        """
+        return self.to_logical(self.state)
+
+    def state_size(self):
+        # amplitudes held in memory, 2^(qubits in the layout)
+        return self.state.size
+
+    def to_logical(self, state):
+        # reorder amplitudes indexed in layout order to the order of self.qubits, with
+        # the known qubits put back in
+        if self.layout == self.qubits:
+            return state
+        order = [self.axes[q] for q in self.qubits if q not in self.known]
+        tensor = state.reshape((2,) * len(self.layout)).transpose(order)
+        if len(self.known) == 0:
+            return tensor.reshape(-1)
+        full = np.zeros((2,) * len(self.qubits), state.dtype)
+        full[tuple(self.known.get(q, slice(None)) for q in self.qubits)] = tensor
+        return full.reshape(-1)
+
+    def materialize(self, qubits):
+        """
+        Give the known qubits among qubits axes of the state, set to their bits
+        """
+        new = [q for q in qubits if q in self.known]
+        if len(new) == 0:
+            return
+        n = self.state.size
+        self.resize(n * 2**len(new))
+        column = 0
+        for qubit in new:
+            column = 2 * column + self.known.pop(qubit)
+        fresh = self.scratch.reshape(n, -1)
+        fresh[:] = 0
+        fresh[:, column] = self.state[:n]
+        self.flip()
+        self.add_qubits(new)
+
+    def fix_known(self, table, qubits):
+        # table indexed by the bits of qubits, restricted to the known bits of some of them
+        if not any(q in self.known for q in qubits):
+            return table, qubits
+        table = table[tuple(self.known.get(q, slice(None)) for q in qubits)]
+        return table, [q for q in qubits if q not in self.known]
+
+    def global_phase(self, phase):
+        if phase != 1:
+            self.state *= phase
+
+    def add_qubits(self, qubits):
+        # qubits already in self.qubits take the last axes of the state
+        for qubit in qubits:
+            self.axes[qubit] = len(self.layout)
+            self.layout.append(qubit)
+
+    def remove_qubits(self, qubits):
+        """
+        Take measured qubits out of the layout (or the known bits). Only the qubits on
+        later axes move down
+        """
+        dense = [q for q in qubits if self.known.pop(q, None) is None]
+        if len(dense) > 0:
+            first = min(self.axes.pop(q) for q in dense)
+            self.layout = [q for q in self.layout if q in self.axes]
+            for p in range(first, len(self.layout)):
+                self.axes[self.layout[p]] = p
+        self.qubits = [q for q in self.qubits if q in self.axes or q in self.known]
+
+    def set_layout(self, qubits):
+        # a state whose axes are qubits in this order, none of them known
+        self.qubits = list(qubits)
+        self.layout = list(qubits)
+        self.axes = {q: p for p, q in enumerate(self.layout)}
+        self.known = {}
+
+    def resize(self, size):
+        """
+        Point state and scratch at the first size amplitudes of the buffers. The buffers
+        only grow, keeping the current state, so shrinking after a measurement is free
+        """
+        if self.buffers[0].size < size:
+            old = self.state
+            self.buffers = [np.zeros(size, self.dtype), np.zeros(size, self.dtype)]
+            self.buffers[0][:old.size] = old
+        self.state = self.buffers[0][:size]
+        self.scratch = self.buffers[1][:size]
+
+    def flip(self):
+        self.buffers.reverse()
+        self.state, self.scratch = self.scratch, self.state
+
+    def temp(self, shape):
+        # scratch viewed with the given shape, free between gates
+        return self.scratch[:int(np.prod(shape))].reshape(shape)
+
+    def cast(self, values):
+        # gate parameters in the precision of the state
+        values = np.asarray(values)
+        if np.iscomplexobj(values) and self.dtype.kind != "c":
+            raise ValueError(f"complex gate on a {self.dtype} state")
+        return values.astype(self.dtype, copy=False)
+
+    def choose(self, probs, overwrite=False):
+        """
+        Index drawn with probability proportional to probs
+        - overwrite: keep the cumulative sums in probs instead of a new array
+        """
+        cum_probs = np.cumsum(probs, out=probs if overwrite else None)
+        r = self.rng.random() * cum_probs[-1]
+        return min(np.searchsorted(cum_probs, r, side="right"), len(cum_probs) - 1)
+
+    def probabilities(self, tensor):
+        """
+        |amplitude|^2 of a view of the state, in the state's precision, written into scratch
+        """
+        if self.dtype.kind != "c":
+            return np.multiply(tensor, tensor, out=self.temp(tensor.shape))
+        # scratch holds twice as many reals as amplitudes: squares of the real and
+        # imaginary parts go in the two halves
+        reals = self.scratch.view(tensor.real.dtype)
+        probs = reals[:tensor.size].reshape(tensor.shape)
+        imag = reals[tensor.size:2 * tensor.size].reshape(tensor.shape)
+        np.multiply(tensor.real, tensor.real, out=probs)
+        np.multiply(tensor.imag, tensor.imag, out=imag)
+        probs += imag
+        return probs
+
+    def exchange(self, tensor, i, j, where=True):
+        """
+        Swap tensor[i] and tensor[j] in place (only where the mask is True). Both halves
+        go through scratch: copying between two interleaved views of the same buffer
+        would make numpy allocate a temporary for the overlap
+        """
+        a, b = tensor[i + (Ellipsis,)], tensor[j + (Ellipsis,)] # views even when i, j index every axis
+        size = a.size
+        tmp_a = self.scratch[:size].reshape(a.shape)
+        tmp_b = self.scratch[size:2 * size].reshape(b.shape)
+        where = np.asarray(where)
+
+        def block(k):
+            mask = where
+            if where.ndim > 0: # size 1 axes of the mask broadcast, only slice the others
+                mask = where[tuple(s if n > 1 else slice(None) for s, n in zip(k, where.shape))]
+            np.copyto(tmp_a[k], a[k])
+            np.copyto(tmp_b[k], b[k])
+            np.copyto(a[k], tmp_b[k], where=mask)
+            np.copyto(b[k], tmp_a[k], where=mask)
+        self.in_blocks(block, a.shape, range(a.ndim))
+
+    def in_blocks(self, func, shape, axes):
+        """
+        Call func with indices of disjoint blocks covering an array of the given shape,
+        split along the longest of axes, on the thread pool if there is one
+        """
+        everything = (slice(None),) * len(shape) + (Ellipsis,) # a view even for 0-d arrays
+        if self.pool is None or int(np.prod(shape)) < MIN_PARALLEL_SIZE or len(axes) == 0:
+            func(everything)
+            return
+        axis = max(axes, key=lambda d: shape[d])
+        bounds = np.linspace(0, shape[axis], min(self.threads, shape[axis]) + 1).astype(int)
+        blocks = [everything[:axis] + (slice(lo, hi),) + everything[axis + 1:]
+                  for lo, hi in zip(bounds[:-1], bounds[1:])]
+        list(self.pool.map(func, blocks)) # list() re-raises errors from the threads
+
+    def tensor(self, *qubits):
+        """
+        View the state as a tensor where each given qubit has its own axis of size 2 and
+        the qubits in between are grouped together, e.g. (left, 2, right) for one qubit.
+        Returns the view and the axis of each qubit
+        """
+        n = len(self.layout)
+        positions = [self.axes[q] for q in qubits]
+        shape, axes, last = [], {}, 0
+        for p in sorted(positions):
+            if p > last:
+                shape.append(2**(p - last))
+            shape.append(2)
+            axes[p] = len(shape) - 1
+            last = p + 1
+        if n > last:
+            shape.append(2**(n - last))
+        return self.state.reshape(shape), [axes[p] for p in positions]
+
+    def broadcast(self, values, axes, ndim):
+        """
+        Reshape values, indexed by the bits of the qubits at axes, so that it broadcasts
+        against an ndim tensor view of the state
+        """
+        order = sorted(range(len(axes)), key=lambda j: axes[j])
+        shape = [2 if a in axes else 1 for a in range(ndim)]
+        return np.transpose(values, order).reshape(shape)
+
+    def marginal(self, *qubits):
+        """
+        Joint distribution of measuring qubits, flattened with the first qubit as the
+        most significant bit. Also returns the tensor view used to compute it
+        """
+        self.materialize(qubits)
+        tensor, axes = self.tensor(*qubits)
+        others = tuple(a for a in range(tensor.ndim) if a not in axes)
+        marginal = np.sum(self.probabilities(tensor), axis=others)
+        marginal = marginal.transpose([sorted(axes).index(a) for a in axes]).reshape(-1)
+        return tensor, axes, marginal
+
+    def index_to_basic_state(self, index, n=None):
+        if n is None:
+            n = len(self.qubits)
+        return format(index, "b").zfill(n) if n > 0 else ""
     
+    def layout_to_basic_state(self, index):
+        # outcome over self.qubits of a basis state indexed in layout order
+        bits = self.index_to_basic_state(index, len(self.layout))
+        return "".join(str(self.known[q]) if q in self.known else bits[self.axes[q]] for q in self.qubits)
+
     def basic_state_to_index(self, basic):
         index = 0
         for c in basic:
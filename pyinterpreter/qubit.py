@@ -4,14 +4,12 @@ counter = 0
 keywords = ["all"]
 
 class Qubit:
+    # every Qubit is a distinct object, so the default identity comparison and hash
+    # (done in C, no Python call per dict lookup) already tell qubits apart
+    __slots__ = ("name", "id")
+
     def __init__(self, name):
         global counter
         self.name = name
         self.id = counter
         counter += 1
-
-    def __eq__(self, __value: object) -> bool:
-        return self.id == __value.id 
-
-    def __hash__(self) -> int:
-        return hash(self.id)
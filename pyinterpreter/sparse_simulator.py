@@ -0,0 +1,206 @@
+import numpy as np
+from qc_simulator import QuantumComputer
+
+# indices are int64 bit strings
+MAX_SPARSE_QUBITS = 62
+# never switch to a dense state larger than this
+MAX_DENSE_QUBITS = 30
+
+class SparseQuantumComputer(QuantumComputer):
+    """
+    State stored as its nonzero amplitudes only: self.indices holds the basis states
+    (in the order of self.layout, like the axes of the dense state) and self.values
+    their amplitudes.
+    Permutations and phases touch each nonzero amplitude once whatever the number of
+    qubits, so classical reversible circuits stay cheap on many qubits. Once more than
+    max_fill of the 2^n amplitudes are nonzero the computer switches to the dense
+    state of QuantumComputer, and back after everything is extracted.
+    - max_fill: fill ratio above which the state becomes dense
+    """
+    def __init__(self, dtype=np.complex128, threads=None, seed=None, max_fill=0.125) -> None:
+        super().__init__(dtype, threads, seed)
+        self.max_fill = max_fill
+        self.sparse = True
+        self.indices = np.zeros(1, np.int64)
+        self.values = np.ones(1, self.dtype)
+        # amplitudes below this are dropped as cancelled
+        self.tolerance = 8 * np.finfo(self.dtype).eps
+
+    # Qubit creation and deletion
+    def new_qubit(self, *args):
+        if not self.sparse:
+            super().new_qubit(*args)
+            return
+        assert len(self.qubits) + len(args) <= MAX_SPARSE_QUBITS
+        self.indices = self.indices << len(args)
+        self.qubits.extend(args)
+        self.add_qubits(args)
+
+    def extract(self, *args):
+        if not self.sparse:
+            output = super().extract(*args)
+            if len(self.qubits) == 0:
+                self.sparse = True
+                self.indices, self.values = np.zeros(1, np.int64), np.ones(1, self.dtype)
+            return output
+
+        if len(args) == 0: # extract all
+            i = self.choose(self.probabilities(self.values))
+            output = self.layout_to_basic_state(int(self.indices[i]))
+            self.set_layout([])
+            self.indices, self.values = np.zeros(1, np.int64), np.ones(1, self.dtype)
+            return output
+
+        sub = self.gather(args)
+        outcomes, probs = self.sparse_marginal(sub)
+        j = self.choose(probs)
+        output = self.index_to_basic_state(int(outcomes[j]), len(args))
+
+        # condition on measurement and drop the measured bits
+        keep = sub == outcomes[j]
+        kept = [q for q in self.layout if q not in args]
+        indices = np.zeros(np.count_nonzero(keep), np.int64)
+        for p, qubit in enumerate(kept):
+            indices |= ((self.indices[keep] >> self.shift(qubit)) & 1) << (len(kept) - 1 - p)
+        self.indices = indices
+        self.values = self.values[keep] / np.sqrt(probs[j]).astype(self.dtype)
+        self.remove_qubits(args)
+
+        return output
+
+    def sample(self, shots, qubits=None):
+        if not self.sparse:
+            return super().sample(shots, qubits)
+        if qubits is None:
+            qubits = self.qubits
+        outcomes, probs = self.sparse_marginal(self.gather(qubits))
+        counts = self.rng.multinomial(shots, probs / np.sum(probs))
+        return {self.index_to_basic_state(int(outcomes[i]), len(qubits)): int(counts[i])
+                for i in np.flatnonzero(counts)}
+
+    # Gates
+    def hadamard(self, *qubits):
+        qubits = qubits if len(qubits) > 0 else list(self.qubits)
+        for i, qubit in enumerate(qubits):
+            if not self.sparse: # the rest as a Walsh-Hadamard transform of the dense state
+                super().hadamard(*qubits[i:])
+                return
+            self.hadamard_single(qubit)
+
+    def single_qubit_op(self, qubit, op):
+        self.multi_qubit_op([qubit], op)
+
+    def multi_qubit_op(self, qubits, op):
+        if not self.sparse:
+            super().multi_qubit_op(qubits, op)
+            return
+        # each nonzero amplitude spreads to the 2^k basis states that differ on qubits
+        k = len(qubits)
+        op = self.cast(op)
+        sub = self.gather(qubits)
+        spread = np.zeros(2**k, np.int64)
+        for j, qubit in enumerate(qubits):
+            spread |= ((np.arange(2**k) >> (k - 1 - j)) & 1) << self.shift(qubit)
+        base = self.indices & ~spread[-1]
+        indices = base[None, :] | spread[:, None]
+        values = op[:, sub] * self.values[None, :]
+        nonzero = values != 0
+        self.combine(indices[nonzero], values[nonzero])
+
+    def controlled_toggle(self, target, controls=(), zero_controls=()):
+        if not self.sparse:
+            super().controlled_toggle(target, controls, zero_controls)
+            return
+        where = np.ones(len(self.indices), bool)
+        for qubit in controls:
+            where &= (self.indices >> self.shift(qubit)) & 1 == 1
+        for qubit in zero_controls:
+            where &= (self.indices >> self.shift(qubit)) & 1 == 0
+        self.indices[where] ^= 1 << self.shift(target)
+
+    def diagonal_op(self, qubits, phases):
+        if not self.sparse:
+            super().diagonal_op(qubits, phases)
+            return
+        self.values *= self.cast(phases).reshape(-1)[self.gather(qubits)]
+
+    def multi_controlled_Z(self, *qubits):
+        if not self.sparse:
+            super().multi_controlled_Z(*qubits)
+            return
+        self.values[self.gather(qubits) == 2**len(qubits) - 1] *= -1
+
+    def reflect_uniform(self, qubits):
+        if not self.sparse:
+            super().reflect_uniform(qubits)
+            return
+        self.reflect_by_hadamard(qubits)
+
+    def toggle_where(self, target, qubits, mask):
+        if not self.sparse:
+            super().toggle_where(target, qubits, mask)
+            return
+        where = np.asarray(mask).reshape(-1)[self.gather(qubits)]
+        self.indices[where] ^= 1 << self.shift(target)
+
+    # Utils
+    def print_state(self):
+        if not self.sparse:
+            super().print_state()
+        elif len(self.qubits) <= 20:
+            state = np.zeros(2**len(self.qubits), self.dtype)
+            state[self.indices] = self.values
+            print(self.to_logical(state))
+        else:
+            print({self.layout_to_basic_state(int(i)): v for i, v in zip(self.indices, self.values)})
+
+    def state_size(self):
+        if not self.sparse:
+            return super().state_size()
+        return len(self.indices)
+
+    def shift(self, qubit):
+        # position of qubit's bit in an index
+        return len(self.layout) - 1 - self.axes[qubit]
+
+    def gather(self, qubits):
+        """
+        Values of qubits in each basis state as an index, the first qubit being the
+        most significant bit
+        """
+        sub = np.zeros(len(self.indices), np.int64)
+        for j, qubit in enumerate(qubits):
+            sub |= ((self.indices >> self.shift(qubit)) & 1) << (len(qubits) - 1 - j)
+        return sub
+
+    def sparse_marginal(self, sub):
+        # outcomes that occur and their probabilities
+        outcomes, inverse = np.unique(sub, return_inverse=True)
+        return outcomes, np.bincount(inverse, self.probabilities(self.values), len(outcomes))
+
+    def probabilities(self, values):
+        if not self.sparse:
+            return super().probabilities(values)
+        return np.abs(values)**2
+
+    def combine(self, indices, values):
+        """
+        Set the state to the sum of values at each index, dropping cancelled amplitudes,
+        and switch to a dense state if it got too full
+        """
+        indices, inverse = np.unique(indices, return_inverse=True)
+        summed = np.bincount(inverse, values.real, len(indices)).astype(self.dtype)
+        if np.iscomplexobj(values):
+            summed += 1j * np.bincount(inverse, values.imag, len(indices))
+        keep = np.abs(summed) > self.tolerance
+        self.indices, self.values = indices[keep], summed[keep]
+        n = len(self.qubits)
+        if n <= MAX_DENSE_QUBITS and len(self.indices) > self.max_fill * 2**n:
+            self.densify()
+
+    def densify(self):
+        self.sparse = False
+        self.resize(2**len(self.qubits))
+        self.state[:] = 0
+        self.state[self.indices] = self.values
+        self.indices = self.values = None
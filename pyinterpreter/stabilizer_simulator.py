@@ -0,0 +1,266 @@
+import numpy as np
+
+# print the amplitudes while the tableau has at most this many qubits
+MAX_PRINT_QUBITS = 16
+
+class NonCliffordError(ValueError):
+    """
+    A gate the stabilizer backend can't run
+    """
+    pass
+
+class StabilizerQuantumComputer:
+    """
+    Stabilizer tableau simulator (Aaronson and Gottesman's CHP) for circuits made of
+    Hadamard, toggle, CNOT and Z (with at most one control). Gates cost O(n) and measurements O(n^2) instead of
+    O(2^n), so circuits over hundreds of qubits are cheap.
+    Rows 0..n-1 of x, z, r are the destabilizers, rows n..2n-1 the stabilizers and row
+    2n is scratch space; a row with bits x, z and sign r is the Pauli (-1)^r P_1...P_n
+    where P_j is I, X, Z or Y for (x_j, z_j) = 00, 10, 01 or 11.
+    Extracted qubits are reset to |0> and their columns reused by the next new qubits.
+    - dtype: type of the amplitudes print_state shows
+    - seed: seed or np.random.Generator for the measurements
+    """
+    def __init__(self, dtype=np.complex128, seed=None) -> None:
+        self.dtype = np.dtype(dtype)
+        self.rng = np.random.default_rng(seed)
+        self.qubits = []
+        self.columns = {} # qubit -> column of the tableau
+        self.free = [] # columns in state |0> not used by any qubit
+        self.n = 0
+        self.x = np.zeros((1, 0), np.uint8)
+        self.z = np.zeros((1, 0), np.uint8)
+        self.r = np.zeros(1, np.uint8)
+
+    # Qubit creation and deletion
+    def new_qubit(self, *args):
+        if len(args) > len(self.free):
+            self.grow(len(args) - len(self.free))
+        for qubit in args:
+            self.columns[qubit] = self.free.pop()
+            self.qubits.append(qubit)
+
+    def extract(self, *args):
+        if len(args) == 0: # extract all
+            args = list(self.qubits)
+        output = ""
+        for qubit in args:
+            a = self.columns.pop(qubit)
+            bit, _ = self.measure(a)
+            if bit == 1:
+                self.x_gate(a)
+            self.free.append(a)
+            self.qubits.remove(qubit)
+            output += str(bit)
+        return output
+
+    def sample(self, shots, qubits=None):
+        """
+        Measure qubits (all qubits if None) shots times without collapsing the state.
+        Returns a histogram of the outcomes.
+        The qubits are measured once, on a copy whose signs are affine functions over
+        GF(2) of the coins of the random measurements: column 0 of each sign row is the
+        constant, column j + 1 the coefficient of the coin of the j-th qubit. Each outcome
+        is then such a function, and all the shots are one product of random coins
+        """
+        if qubits is None:
+            qubits = self.qubits
+        k = len(qubits)
+        saved = self.x, self.z, self.r
+        self.x, self.z = self.x.copy(), self.z.copy()
+        self.r = np.zeros((len(saved[2]), k + 1), np.uint8)
+        self.r[:, 0] = saved[2]
+        forms, random = np.zeros((k, k + 1), np.uint8), []
+        for j, qubit in enumerate(qubits):
+            coin = np.zeros(k + 1, np.uint8)
+            coin[j + 1] = 1
+            forms[j], was_random = self.measure(self.columns[qubit], coin)
+            if was_random:
+                random.append(j + 1)
+        self.x, self.z, self.r = saved
+
+        coins = self.rng.integers(2, size=(shots, len(random)), dtype=np.int32)
+        outcomes = (forms[:, 0] + coins @ forms[:, random].T.astype(np.int32)) % 2
+        values, counts = np.unique(outcomes, axis=0, return_counts=True)
+        return {"".join(map(str, value)): int(count) for value, count in zip(values, counts)}
+
+    # Gates
+    def hadamard(self, *qubits):
+        if len(qubits) == 0:
+            qubits = self.qubits
+        for qubit in qubits:
+            a = self.columns[qubit]
+            self.r ^= self.x[:, a] & self.z[:, a]
+            self.x[:, a], self.z[:, a] = self.z[:, a].copy(), self.x[:, a].copy()
+
+    def pauli_X(self, qubit):
+        self.x_gate(self.columns[qubit])
+
+    def toggle(self, qubit):
+        self.x_gate(self.columns[qubit])
+
+    def NOT(self, qubit):
+        self.x_gate(self.columns[qubit])
+
+    def CNOT(self, A, B):
+        a, b = self.columns[A], self.columns[B]
+        self.r ^= self.x[:, a] & self.z[:, b] & (self.x[:, b] ^ self.z[:, a] ^ 1)
+        self.x[:, b] ^= self.x[:, a]
+        self.z[:, a] ^= self.z[:, b]
+
+    def if_A_then_toggle_B(self, A, B):
+        self.CNOT(A, B)
+
+    def if_not_A_then_toggle_B(self, A, B):
+        self.toggle(A)
+        self.CNOT(A, B)
+        self.toggle(A)
+
+    def if_A_then_minus(self, A):
+        # Z negates the X and Y on column a
+        a = self.columns[A]
+        self.r ^= self.x[:, a]
+
+    def controlled_Z(self, A, B):
+        self.hadamard(B)
+        self.CNOT(A, B)
+        self.hadamard(B)
+
+    def multi_controlled_Z(self, *qubits):
+        if len(qubits) == 1:
+            self.if_A_then_minus(*qubits)
+        elif len(qubits) == 2:
+            self.controlled_Z(*qubits)
+        else:
+            self.non_clifford()
+
+    def swap(self, A, B):
+        # relabel the columns instead of moving the tableau
+        self.columns[A], self.columns[B] = self.columns[B], self.columns[A]
+
+    def non_clifford(self, *args):
+        raise NonCliffordError("the stabilizer backend only runs Hadamard, toggle, CNOT, Z and CZ")
+
+    CCNOT = if_A_and_B_then_toggle_C = if_A_or_B_then_toggle_C = non_clifford
+    rotate = single_qubit_op = multi_qubit_op = diagonal_op = toggle_where = non_clifford
+    toggle_f_onto_Cs = if_f_then_minus = apply_phase = phase = reflect_uniform = non_clifford
+
+    # Utils
+    def print_state(self):
+        # amplitudes over the qubits (up to a global phase) while there are few of them
+        if self.n > MAX_PRINT_QUBITS:
+            print(self.generators())
+            return
+        state = self.to_dense()
+        print(state if self.dtype.kind == "c" else state.real.astype(self.dtype))
+
+    def grow(self, k):
+        # add k columns in state |0>: destabilizer X and stabilizer Z on each
+        n, m = self.n, self.n + k
+        x = np.zeros((2 * m + 1, m), np.uint8)
+        z = np.zeros((2 * m + 1, m), np.uint8)
+        r = np.zeros(2 * m + 1, np.uint8)
+        for old, new in ((slice(0, n), slice(0, n)), (slice(n, 2 * n), slice(m, m + n))):
+            x[new, :n], z[new, :n], r[new] = self.x[old], self.z[old], self.r[old]
+        for j in range(n, m):
+            x[j, j] = 1
+            z[m + j, j] = 1
+        self.x, self.z, self.r, self.n = x, z, r, m
+        self.free.extend(range(m - 1, n - 1, -1))
+
+    def state_size(self):
+        # bits of the tableau
+        return self.x.size + self.z.size + self.r.size
+
+    def x_gate(self, a):
+        self.r ^= self.z[:, a]
+
+    def rowsum(self, rows, i):
+        """
+        Multiply the generators in rows by generator i, keeping track of the sign
+        """
+        x1, z1 = self.x[i].astype(int), self.z[i].astype(int)
+        x2, z2 = self.x[rows].astype(int), self.z[rows].astype(int)
+        # power of i picked up on each qubit when multiplying the two Paulis
+        g = (x1 * z1 * (z2 - x2) + x1 * (1 - z1) * z2 * (2 * x2 - 1)
+             + (1 - x1) * z1 * x2 * (1 - 2 * z2))
+        # the product's sign is r_rows + r_i + g / 2 (mod 2), g being 0 or 2 mod 4
+        self.r[rows] ^= self.r[i]
+        constant = self.r if self.r.ndim == 1 else self.r[:, 0]
+        constant[rows] ^= (g.sum(axis=-1) % 4 == 2).astype(np.uint8)
+        self.x[rows] ^= self.x[i]
+        self.z[rows] ^= self.z[i]
+
+    def measure(self, a, coin=None):
+        """
+        Measure column a. Returns the outcome and whether it was random
+        - coin: sign row a random outcome gets instead of a drawn bit, when the signs are
+          affine functions of coins (see sample); the outcome is then such a row too
+        """
+        n = self.n
+        anticommuting = np.flatnonzero(self.x[n:2 * n, a])
+        if len(anticommuting) > 0:
+            p = n + anticommuting[0]
+            rows = np.flatnonzero(self.x[:2 * n, a])
+            rows = rows[rows != p]
+            if len(rows) > 0:
+                self.rowsum(rows, p)
+            self.x[p - n], self.z[p - n], self.r[p - n] = self.x[p], self.z[p], self.r[p]
+            self.x[p], self.z[p] = 0, 0
+            self.z[p, a] = 1
+            self.r[p] = self.rng.integers(2) if coin is None else coin
+            return self.sign(p), True
+        # deterministic: the outcome is the sign of the product of some stabilizers
+        s = 2 * n
+        self.x[s], self.z[s], self.r[s] = 0, 0, 0
+        for i in np.flatnonzero(self.x[:n, a]):
+            self.rowsum(s, i + n)
+        return self.sign(s), False
+
+    def sign(self, row):
+        return int(self.r[row]) if self.r.ndim == 1 else self.r[row].copy()
+
+    def to_dense(self):
+        """
+        State vector over self.qubits, the first nonzero amplitude made real positive
+        """
+        n = self.n
+        # a basis state in the support, measured on a copy without using self.rng
+        saved = self.x, self.z, self.r, self.rng
+        self.x, self.z, self.r = (a.copy() for a in saved[:3])
+        self.rng = np.random.default_rng(0)
+        start = sum(self.measure(a)[0] << (n - 1 - a) for a in range(n))
+        self.x, self.z, self.r, self.rng = saved
+
+        # project |start> onto the state with prod (I + S) / 2 over the stabilizers S
+        basis = np.arange(2**n)
+        state = np.zeros(2**n, complex)
+        state[start] = 1
+        for row in range(n, 2 * n):
+            flip, parity = 0, np.zeros(2**n, int)
+            for a in range(n):
+                flip |= int(self.x[row, a]) << (n - 1 - a)
+                if self.z[row, a]:
+                    parity ^= (basis >> (n - 1 - a)) & 1
+            phase = (-1)**int(self.r[row]) * 1j**int(np.sum(self.x[row] & self.z[row]))
+            applied = np.zeros_like(state)
+            applied[basis ^ flip] = phase * (-1)**parity * state
+            state = (state + applied) / 2
+        state /= np.linalg.norm(state)
+        first = state[np.flatnonzero(np.abs(state) > 1e-9)[0]]
+        state *= np.conj(first) / np.abs(first)
+
+        # free columns are |0>, keep those entries and order the others like self.qubits
+        index = tuple(slice(None) if a in self.columns.values() else 0 for a in range(n))
+        live = sorted(self.columns.values())
+        order = [live.index(self.columns[q]) for q in self.qubits]
+        return state.reshape((2,) * n)[index].transpose(order).reshape(-1).astype(complex)
+
+    def generators(self):
+        # the stabilizers as strings over self.qubits, e.g. +XX, +ZZ for an EPR pair,
+        # leaving out the Z of free columns
+        paulis = np.array(["I", "X", "Z", "Y"])
+        columns = [self.columns[q] for q in self.qubits]
+        rows = [row for row in range(self.n, 2 * self.n) if np.any(self.x[row, columns] | self.z[row, columns])]
+        return ["+-"[int(self.r[row])] + "".join(paulis[self.x[row, columns] + 2 * self.z[row, columns]])
+                for row in rows]
@@ -0,0 +1,87 @@
+import os
+import tempfile
+import numpy as np
+import pytest
+from compiler import ParseError
+from interperter import QuantumInterpreter
+
+def run(source):
+    """
+    Run a QCode program given as text on the in-memory backend. Returns the interpreter,
+    whose qc holds the final state of the qubits main did not extract
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        file_name = os.path.join(folder, "program.qcode")
+        with open(file_name, "w") as file:
+            file.write(source)
+        interpreter = QuantumInterpreter(verbose=False, seed=0, clifford_backend=None)
+        interpreter.parse(file_name)
+        interpreter.run()
+    return interpreter
+
+def test_repeat_after_extract():
+    # long loops take the matrix power path, over the frame's qubits that are left
+    program = """
+def main():
+    new qubit A, B
+    Hadamard B
+    extract B
+    repeat COUNT
+        Hadamard A
+    end
+"""
+    assert np.allclose(run(program.replace("COUNT", "1000")).qc.amplitudes(), [1, 0])
+    assert np.allclose(run(program.replace("COUNT", "1001")).qc.amplitudes(), [2**-0.5, 2**-0.5])
+
+def test_perp_undoes_calls():
+    # undo U calls undo V: reflecting about U|00> = (|00> + |11>)/sqrt(2)
+    program = """
+def V(a, b):
+    Hadamard a
+    if a then toggle b
+
+def U(a, b):
+    call V(a, b)
+
+def main():
+    new qubit a, b
+    Hadamard a
+    if perp U(a, b) then minus
+"""
+    assert np.allclose(run(program).qc.amplitudes(), [0, 0, -2**-0.5, 2**-0.5])
+
+def test_perp_undoes_repeat():
+    # undo U keeps the loop a block around its undone body
+    program = """
+def U(a, b):
+    Hadamard a
+    repeat 2
+        if a then toggle b
+        Hadamard b
+    end
+
+def main():
+    new qubit a, b
+    Hadamard a
+    toggle b
+    if perp U(a, b) then minus
+"""
+    assert np.allclose(run(program).qc.amplitudes(), [-2**-0.5, -2**-0.5, 0, 0])
+
+def test_perp_rejects_new():
+    program = """
+def U(a):
+    new qubit b
+    if a then toggle b
+
+def main():
+    new qubit a
+    if perp U(a) then minus
+"""
+    with pytest.raises(ParseError):
+        run(program)
+
+if __name__ == "__main__":
+    test_repeat_after_extract()
+    test_perp_undoes_calls()
+    test_perp_undoes_repeat()
@@ -0,0 +1,140 @@
+import numpy as np
+
+class SingleQubitGate:
+    def __init__(self, qubit, op) -> None:
+        self.qubit = qubit
+        self.op = op
+        self.qubits = (qubit,)
+
+    def apply(self, qc):
+        qc.single_qubit_op(self.qubit, self.op)
+
+    def matrix(self):
+        return self.op
+
+class ToggleGate:
+    def __init__(self, target, controls=(), zero_controls=()) -> None:
+        self.target = target
+        self.controls = tuple(controls)
+        self.zero_controls = tuple(zero_controls)
+        self.qubits = (target, *self.controls, *self.zero_controls)
+
+    def apply(self, qc):
+        qc.controlled_toggle(self.target, self.controls, self.zero_controls)
+
+    def matrix(self):
+        if len(self.qubits) == 1:
+            return np.array([[0, 1], [1, 0]])
+        return None
+
+    def key(self):
+        return self.target, frozenset(self.controls), frozenset(self.zero_controls)
+
+class SwapGate:
+    def __init__(self, A, B) -> None:
+        self.qubits = (A, B)
+
+    def apply(self, qc):
+        qc.swap(*self.qubits)
+
+    def matrix(self):
+        return None
+
+class MaskedToggleGate:
+    """
+    Toggle target where mask[b1, ..., bk] is True, b1..bk being the values of qubits
+    """
+    def __init__(self, target, qubits, mask) -> None:
+        self.target = target
+        self.controls = tuple(qubits)
+        self.mask = mask
+        self.qubits = (target, *self.controls)
+
+    def apply(self, qc):
+        qc.toggle_where(self.target, self.controls, self.mask)
+
+    def matrix(self):
+        return None
+
+    def same(self, other):
+        return self.qubits == other.qubits and np.array_equal(self.mask, other.mask)
+
+class DiagonalGate:
+    """
+    Multiply each basis state by phases[b1, ..., bk] where b1..bk are the values of qubits
+    """
+    def __init__(self, qubits, phases) -> None:
+        self.qubits = tuple(qubits)
+        self.phases = phases
+
+    def apply(self, qc):
+        qc.diagonal_op(self.qubits, self.phases)
+
+    def matrix(self):
+        if len(self.qubits) == 1:
+            return np.diag(self.phases)
+        return None
+
+    def expand(self, qubits):
+        """
+        Phases as a tensor over qubits (a superset of self.qubits), size 1 on the others
+        """
+        order = sorted(range(len(self.qubits)), key=lambda j: qubits.index(self.qubits[j]))
+        shape = [2 if q in self.qubits else 1 for q in qubits]
+        return np.transpose(self.phases, order).reshape(shape)
+
+
+def merge(prev, gate, fresh):
+    """
+    Combine gate with prev, the gate right before it on all of its qubits.
+    fresh is True if some qubit of gate has no earlier gate at all.
+    Returns the combined gate, None if the two cancel, or prev itself if they don't combine
+    """
+    if isinstance(prev, DiagonalGate) and isinstance(gate, DiagonalGate):
+        # diagonal gates commute, so they combine even on different qubits
+        qubits = list(prev.qubits) + [q for q in gate.qubits if q not in prev.qubits]
+        phases = prev.expand(qubits) * gate.expand(qubits)
+        return None if np.allclose(phases, 1) else DiagonalGate(qubits, phases)
+    if fresh or set(prev.qubits) != set(gate.qubits):
+        return prev
+    if isinstance(prev, ToggleGate) and isinstance(gate, ToggleGate) and prev.key() == gate.key():
+        return None
+    if isinstance(prev, SwapGate) and isinstance(gate, SwapGate):
+        return None
+    if isinstance(prev, MaskedToggleGate) and isinstance(gate, MaskedToggleGate) and prev.same(gate):
+        return None
+    if prev.matrix() is not None and gate.matrix() is not None:
+        op = gate.matrix() @ prev.matrix()
+        return None if np.allclose(op, np.eye(2)) else SingleQubitGate(gate.qubits[0], op)
+    return prev
+
+def optimize(gates):
+    """
+    Peephole pass over a recorded circuit: fuses neighbouring single qubit gates on the
+    same qubit into one 2x2 op, cancels self-inverse pairs (toggles, CNOTs, swaps,
+    H H, f oracles) and merges neighbouring diagonal gates
+    """
+    out = []
+    history = {} # qubit -> indices into out of the gates acting on it, in order
+    for gate in gates:
+        stacks = [history.setdefault(q, []) for q in gate.qubits]
+        tops = {stack[-1] for stack in stacks if len(stack) > 0}
+        if len(tops) == 1:
+            i = tops.pop()
+            prev = out[i]
+            merged = merge(prev, gate, any(len(stack) == 0 for stack in stacks))
+            if merged is None: # cancelled, the gates before prev become the last ones again
+                out[i] = None
+                for q in prev.qubits:
+                    history[q].remove(i)
+                continue
+            if merged is not prev:
+                out[i] = merged
+                for q in merged.qubits:
+                    if i not in history.setdefault(q, []):
+                        history[q].append(i)
+                continue
+        out.append(gate)
+        for stack in stacks:
+            stack.append(len(out) - 1)
+    return [gate for gate in out if gate is not None]
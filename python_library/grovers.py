@@ -9,8 +9,9 @@ def R():
     q.if_perp_then_minus(q.hadamard, q.hadamard, "B1", "B2", "B3", "B4")
 
 q.new_qubit("B1", "B2", "B3", "B4")
-q.hadamard()
-for t in range(3):
-    R()
+with q.deferred():
+    q.hadamard()
+    for t in range(3):
+        R()
 out = q.extract()
 print(out)
\ No newline at end of file
@@ -1,49 +1,44 @@
 from quantum_computer import QuantumComputer
+from shot_farm import farm, run_experiment
+from functools import partial
 import random
 import numpy as np
 
 q = QuantumComputer()
 
-angle = random.randint(0, 90)
-print("MysteryRot:", angle)
-
-def IsMedium(angle):
-    count = 0
-    for t in range(100):
-        q.new_qubit("A")
-        q.rotate("A", angle)
-        a = q.extract()[0]
-        if a == "1": count += 1
+def IsMedium(angle, q=q):
+    q.new_qubit("A")
+    q.rotate("A", angle)
+    count = q.sample(100).get("1", 0)
+    q.extract()
     return 20 <= count <= 80
 
 def Factor2Estimate(angle):
-    k_max = 2**10
-    k = 2
-    while k < k_max:
-        if IsMedium(angle * k):
+    # try every k = 2, 4, ..., 2^9 at once in a batched computer
+    ks = 2 ** np.arange(1, 10)
+    qb = QuantumComputer(batch=len(ks))
+    qb.new_qubit("A")
+    qb.rotate("A", angle * ks)
+    counts = qb.sample(100)
+    qb.extract()
+    for k, count in zip(ks, counts):
+        if 20 <= count.get("1", 0) <= 80:
             return 45 / k
-        k *= 2
 
 #pred = Factor2Estimate(angle)
 #print(pred)
 
-def IntervalEstimate(angle):
-    count = 0
+def IntervalEstimate(angle, q=q):
     T = 120000
-    for i in range(T):
-        q.new_qubit("A")
-        q.rotate("A", angle)
-        a = q.extract()[0]
-        if a == "1": count += 1
+    q.new_qubit("A")
+    q.rotate("A", angle)
+    count = q.sample(T).get("1", 0)
+    q.extract()
     qh = count / T
-    theta = np.math.asin(np.math.sqrt(qh))
-    return theta * 180 / np.math.pi
-
-pred = IntervalEstimate(angle)
-print("Predicted", pred)
-
+    theta = np.arcsin(np.sqrt(qh))
+    return theta * 180 / np.pi
 
-def HadamardTest():
+def HadamardTest(q=q):
     q.new_qubit("D")
     q.hadamard("D")
     # if D then R on A1, ..., Am
@@ -53,7 +48,18 @@ def HadamardTest():
 C = 120000
 def RotationEstimation(n, R, *As):
     for i in range(n):
-        for _ in range(C):
-            q.new_qubit("D")
-            R("D")
-            d = q.extract()[0]
\ No newline at end of file
+        q.new_qubit("D")
+        R("D")
+        counts = q.sample(C)
+        q.extract()
+
+if __name__ == "__main__":
+    angle = random.randint(0, 90)
+    print("MysteryRot:", angle)
+
+    pred = IntervalEstimate(angle)
+    print("Predicted", pred)
+
+    # IsMedium is random near its thresholds: run it on many independent computers
+    counts = farm(partial(run_experiment, partial(IsMedium, angle)), 10000, seed=0)
+    print("IsMedium:", dict(counts))
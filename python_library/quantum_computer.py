@@ -1,183 +1,326 @@
 import numpy as np
-import random
+from contextlib import contextmanager
 from qubit import Qubit
+import parse_cache
+from circuit import SingleQubitGate, ToggleGate, SwapGate, DiagonalGate, MaskedToggleGate, optimize
 
 class QuantumComputer:
-    def __init__(self) -> None:
+    """
+    State vector simulator. With batch=B the computer holds B independent states of the
+    same qubits in a (B, 2^n) array: every gate is applied to all of them in one pass,
+    gate parameters (e.g. rotate angles) may be given per state, and measurements return
+    one outcome per state.
+    dtype is the precision of the amplitudes: complex128 by default, complex64 or float32
+    (real amplitudes only) to save memory. seed (a seed or np.random.Generator) makes
+    the measurements reproducible
+    """
+    def __init__(self, batch=None, dtype=np.complex128, seed=None) -> None:
+        self.batch = batch
+        self.dtype = np.dtype(dtype)
+        self.rng = np.random.default_rng(seed)
         self.qubits = []
-        self.state = np.ones(1)
+        self.axes = {} # qubit -> its position in qubits, the axis of the state it indexes
+        self.state = self.empty_state()
+        self.circuit = None # gates recorded in deferred mode
+
+    # Deferred execution
+    @contextmanager
+    def deferred(self):
+        """
+        Record gates instead of applying them, then optimize the recorded circuit and
+        apply it when the block ends (or earlier when a measurement needs the state)
+        """
+        self.circuit = []
+        try:
+            yield self
+        finally:
+            self.flush()
+            self.circuit = None
+
+    def flush(self):
+        if not self.circuit:
+            return
+        gates, self.circuit = optimize(self.circuit), None
+        for gate in gates:
+            gate.apply(self)
+        self.circuit = []
 
     # Qubit creation and deletion
     def new_qubit(self, *args):
+        # a fresh |0> qubit commutes with pending gates, so there is no need to flush
         for qubit in args:
+            self.axes[qubit] = len(self.qubits)
             self.qubits.append(qubit)
-            self.state = np.kron(self.state, np.array([1.0, 0.0]))
+            new_state = np.zeros(self.state.shape[:-1] + (2 * self.state.shape[-1],), self.dtype)
+            new_state[..., ::2] = self.state
+            self.state = new_state
  
     def extract(self, *args):
+        self.flush()
         if len(args) == 0: # extract all
-            probs = self.state * self.state 
-            r = random.random()
-            cum_prob = 0
-            for i in range(probs.shape[0]):
-                p = probs[i]
-                if cum_prob <= r < cum_prob + p:
-                    output = self.index_to_basic_state(i)
-                    #print(f"Measurement of {''.join(self.qubits)}: {output}")
-                    break
-                cum_prob += p
-
-            self.qubits = []
-            self.state = np.ones(1)
+            outcome = self.choose(self.probabilities(self.state))
+            output = self.outcome_to_basic_states(outcome, len(self.qubits))
+            #print(f"Measurement of {''.join(self.qubits)}: {output}")
+
+            self.qubits, self.axes = [], {}
+            self.state = self.empty_state()
             return output
-        output = "" 
-        for qubit in args:
-            probs = self.state * self.state 
-            r = random.random()
-            i = self.qubits.index(qubit)
-            res_0, res_1 = 0.0, 0.0
-            for j in range(len(self.state)):
-                basic = self.index_to_basic_state(j)
-                if basic[i] == "0": res_0 += probs[j]
-                else: res_1 += probs[j]
-            final = r < res_0 # measurement is 0
-
-            new_state = np.zeros(len(self.state)//2)
-            index = 0
-            # conidition on measurement
-            for j in range(len(self.state)):
-                basic = self.index_to_basic_state(j)
-                if (basic[i] == "0" and final) or (basic[i] == "1" and not final):
-                    new_state[index] = self.state[j]
-                    index += 1
-            # normalize
-            factor = np.math.sqrt(np.sum(new_state * new_state))
-            new_state /= factor
-            self.state = new_state
-            self.qubits.remove(qubit)
 
-            #if final: print(f"Measurement of {qubit}: 0")
-            #else: print(f"Measurement of {qubit}: 1")
-            output += ("0" if final else "1")
+        tensor, axes, marginal = self.marginal(*args)
+        outcome = self.choose(marginal)
+        output = self.outcome_to_basic_states(outcome, len(args))
+
+        # condition on measurement
+        index = [slice(None)] * tensor.ndim
+        for j, axis in enumerate(axes):
+            index[axis] = (outcome >> (len(args) - 1 - j)) & 1
+        if self.batch is None:
+            norm = np.sqrt(marginal[outcome])
+        else: # advanced indexing puts the batch axis first
+            index[0] = np.arange(self.batch)
+            norm = np.sqrt(marginal[index[0], outcome])[:, None]
+        self.state = tensor[tuple(index)].reshape(self.state.shape[:-1] + (-1,)) / norm
+        # only the qubits after the first measured one move down
+        first = min(self.axes.pop(q) for q in args)
+        self.qubits = [q for q in self.qubits if q in self.axes]
+        for p in range(first, len(self.qubits)):
+            self.axes[self.qubits[p]] = p
 
         return output
 
+    def sample(self, shots, qubits=None):
+        """
+        Measure qubits (all qubits if None) shots times without collapsing the state.
+        Returns a histogram of the outcomes, or a list of histograms in batch mode
+        """
+        self.flush()
+        if qubits is None:
+            qubits = self.qubits
+        _, _, marginal = self.marginal(*qubits)
+        counts = self.rng.multinomial(shots, marginal / np.sum(marginal, axis=-1, keepdims=True))
+        histograms = [{self.index_to_basic_state(i, len(qubits)): int(row[i]) for i in np.flatnonzero(row)}
+                      for row in counts.reshape(-1, counts.shape[-1])]
+        return histograms[0] if self.batch is None else histograms
+
     # Hadamard
     def hadamard(self, qubit=None):
-        hadamard = np.array([[1, 1], [1, -1]]) / np.math.sqrt(2)
-        if qubit is None: # hadamard all
-            matrix = hadamard
-            for _ in range(1, len(self.qubits)):
-                matrix = np.kron(matrix, hadamard)
-            self.state = matrix @ self.state
+        hadamard = np.array([[1, 1], [1, -1]]) / np.sqrt(2)
+        if qubit is None and self.circuit is not None: # record hadamard all as single qubit gates
+            for q in self.qubits:
+                self.single_qubit_op(q, hadamard)
+        elif qubit is None: # hadamard all
+            self.walsh_hadamard()
         else:
             self.single_qubit_op(qubit, hadamard)
 
+    def walsh_hadamard(self):
+        """
+        Hadamard on every qubit as a fast Walsh-Hadamard transform: an in-place add/subtract
+        butterfly per qubit and one final rescale, O(n 2^n) instead of a 2^n x 2^n matrix
+        """
+        n, lead = len(self.qubits), self.state.shape[:-1]
+        for p in range(n):
+            tensor = self.state.reshape(lead + (2**p, 2, 2**(n - 1 - p)))
+            zero, one = tensor[..., 0, :], tensor[..., 1, :]
+            old = zero.copy()
+            zero += one
+            np.subtract(old, one, out=one)
+        self.state *= self.cast(2 ** (-n / 2))
+
     ### Classical Reversible ###
     # Single qubit operations
     def pauli_X(self, qubit):
         self.toggle(qubit)
 
     def toggle(self, qubit):
-        i = self.qubits.index(qubit)
-        new_state = np.zeros_like(self.state)
-        for j in range(len(self.state)):
-            n = len(self.qubits)
-            bit = ((j >> (n - 1 - i)) % 2)
-            add = 1 << (n - 1 - i)
-            k = j + (add if bit == 0 else -add)
-            new_state[j] = self.state[k]
-        self.state = new_state
+        self.controlled_toggle(qubit)
 
     def rotate(self, qubit, angle):
-        sin = np.math.sin(angle / 180 * np.math.pi)
-        cos = np.math.cos(angle / 180 * np.math.pi)
-        rotation = np.array([[cos, -sin], [sin, cos]])
+        # angle may be an array with one angle per batch entry
+        sin = np.sin(np.asarray(angle) / 180 * np.pi)
+        cos = np.cos(np.asarray(angle) / 180 * np.pi)
+        rotation = np.stack([np.stack([cos, -sin], -1), np.stack([sin, cos], -1)], -2)
         self.single_qubit_op(qubit, rotation)   
 
     def single_qubit_op(self, qubit, op):
-        identity = np.array([[1, 0], [0, 1]])
-        matrix = None
-        for q in self.qubits:
-            if q == qubit:
-                if matrix is None:
-                    matrix = op 
-                else:
-                    matrix = np.kron(matrix, op)
-            else:
-                if matrix is None:
-                    matrix = identity
-                else:
-                    matrix = np.kron(matrix, identity)
-        self.state = matrix @ self.state
+        # apply op along the qubit's axis only, O(2^n) instead of a 2^n x 2^n matrix
+        # op is 2x2, or (batch, 2, 2) for a different op per batch entry
+        if self.circuit is not None:
+            self.circuit.append(SingleQubitGate(qubit, op))
+            return
+        tensor, (axis,) = self.tensor(qubit)
+        lead = self.state.ndim - 1
+        tensor = tensor.reshape(self.state.shape[:-1] + (int(np.prod(tensor.shape[lead:axis])), 2, -1))
+        self.state = np.einsum("...ab,...ibj->...iaj", self.cast(op), tensor).reshape(self.state.shape)
 
     # Multi-qubit operations
     def CNOT(self, A, B):
-        i1, i2 = self.qubits.index(A), self.qubits.index(B)
-        new_state = np.zeros_like(self.state)
-        for i in range(len(self.state)):
-            basic = self.index_to_basic_state(i)
-            if basic[i1] == "1":
-                target = basic[:i2] + ("1" if basic[i2] == "0" else "0") + basic[i2+1:]
-                new_state[i] = self.state[self.basic_state_to_index(target)]
-            else:
-                new_state[i] = self.state[i]
-        self.state = new_state
+        self.controlled_toggle(B, [A])
 
     def if_A_then_toggle_B(self, A, B):
         self.CNOT(A, B)
         
     def CCNOT(self, A, B, C):
-        i1, i2, i3 = self.qubits.index(A), self.qubits.index(B), self.qubits.index(C)
-        new_state = np.zeros_like(self.state)
-        for i in range(len(self.state)):
-            basic = self.index_to_basic_state(i)
-            if basic[i1] == "1" and basic[i2] == "1":
-                target = basic[:i3] + ("1" if basic[i3] == "0" else "0") + basic[i3+1:]
-                new_state[i] = self.state[self.basic_state_to_index(target)]
-            else:
-                new_state[i] = self.state[i]
-        self.state = new_state
+        self.controlled_toggle(C, [A, B])
     
     def if_A_and_B_then_toggle_C(self, A, B, C):
         self.CCNOT(A, B, C)
 
     def swap(self, A, B):
-        i1, i2 = self.qubits.index(A), self.qubits.index(B)
-        new_state = np.zeros_like(self.state)
-        for i in range(len(self.state)):
-            basic = self.index_to_basic_state(i)
-            target = basic
-            target[i1] = basic[i2]
-            target[i2] = basic[i1]
-            new_state[i] = self.state[self.basic_state_to_index(target)]
-        self.state = new_state
+        if self.circuit is not None:
+            self.circuit.append(SwapGate(A, B))
+            return
+        tensor, (a, b) = self.tensor(A, B)
+        index = [slice(None)] * tensor.ndim
+        index[a], index[b] = 0, 1
+        zero_one = tuple(index)
+        index[a], index[b] = 1, 0
+        one_zero = tuple(index)
+        tmp = tensor[zero_one].copy()
+        tensor[zero_one] = tensor[one_zero]
+        tensor[one_zero] = tmp
     
     def if_A_or_B_then_toggle_C(self, A, B, C):
-        self.toggle(A)
-        self.toggle(B)
-        self.if_A_and_B_then_toggle_C(A, B, C)
+        # A OR B == NOT (NOT A AND NOT B)
         self.toggle(C)
-        self.toggle(B)
-        self.toggle(A)
+        self.controlled_toggle(C, zero_controls=[A, B])
 
     def if_not_A_then_toggle_B(self, A, B):
-        self.toggle(A)
-        self.if_A_then_toggle_B(A, B)
-        self.toggle(A)
+        self.controlled_toggle(B, zero_controls=[A])
+
+    def controlled_toggle(self, target, controls=(), zero_controls=()):
+        """
+        Toggle target on the basis states where all controls are 1 and all zero_controls are 0.
+        Swaps the two target slices of the state in place, no per-amplitude work
+        """
+        if self.circuit is not None:
+            self.circuit.append(ToggleGate(target, controls, zero_controls))
+            return
+        tensor, axes = self.tensor(target, *controls, *zero_controls)
+        index = [slice(None)] * tensor.ndim
+        for axis in axes[1:len(controls) + 1]:
+            index[axis] = 1
+        for axis in axes[len(controls) + 1:]:
+            index[axis] = 0
+        index[axes[0]] = 0
+        zero = tuple(index)
+        index[axes[0]] = 1
+        one = tuple(index)
+        tmp = tensor[zero].copy()
+        tensor[zero] = tensor[one]
+        tensor[one] = tmp
     
+    def diagonal_op(self, qubits, phases):
+        """
+        Multiply every basis state by phases[b1, ..., bk] where b1..bk are the values of qubits
+        """
+        if self.circuit is not None:
+            self.circuit.append(DiagonalGate(qubits, phases))
+            return
+        tensor, axes = self.tensor(*qubits)
+        tensor *= self.broadcast(self.cast(phases), axes, tensor.ndim)
+
+    def toggle_where(self, target, qubits, mask):
+        """
+        Toggle target on the basis states where mask[b1, ..., bk] is True, b1..bk being
+        the values of qubits (which must not include target)
+        """
+        if self.circuit is not None:
+            self.circuit.append(MaskedToggleGate(target, qubits, mask))
+            return
+        tensor, axes = self.tensor(target, *qubits)
+        mask = np.take(self.broadcast(mask, axes[1:], tensor.ndim), 0, axis=axes[0])
+        index = [slice(None)] * tensor.ndim
+        index[axes[0]] = 0
+        zero = tensor[tuple(index)]
+        index[axes[0]] = 1
+        one = tensor[tuple(index)]
+        tmp = np.where(mask, one, zero)
+        one[...] = np.where(mask, zero, one)
+        zero[...] = tmp
+
     # Utils
     def print_state(self):
+        self.flush()
         print(self.state)
 
-    def index_to_basic_state(self, index):
-        state = ""
-        for _ in range(len(self.qubits)):
-            if index % 2 == 0:
-                state = "0" + state
-            else:
-                state = "1" + state
-            index = index // 2
-        return state
+    def tensor(self, *qubits):
+        """
+        View the state as a tensor where each given qubit has its own axis of size 2 and
+        the qubits in between are grouped together, e.g. (left, 2, right) for one qubit.
+        In batch mode the batch axis stays first. Returns the view and the axis of each qubit
+        """
+        n = len(self.qubits)
+        positions = [self.axes[q] for q in qubits]
+        shape, axes, last = list(self.state.shape[:-1]), {}, 0
+        for p in sorted(positions):
+            if p > last:
+                shape.append(2**(p - last))
+            shape.append(2)
+            axes[p] = len(shape) - 1
+            last = p + 1
+        if n > last:
+            shape.append(2**(n - last))
+        return self.state.reshape(shape), [axes[p] for p in positions]
+
+    def broadcast(self, values, axes, ndim):
+        """
+        Reshape values, indexed by the bits of the qubits at axes, so that it broadcasts
+        against an ndim tensor view of the state
+        """
+        order = sorted(range(len(axes)), key=lambda j: axes[j])
+        shape = [2 if a in axes else 1 for a in range(ndim)]
+        return np.transpose(values, order).reshape(shape)
+
+    def marginal(self, *qubits):
+        """
+        Joint distribution of measuring qubits, flattened with the first qubit as the
+        most significant bit. Also returns the tensor view used to compute it
+        """
+        tensor, axes = self.tensor(*qubits)
+        lead = self.state.ndim - 1
+        others = tuple(a for a in range(lead, tensor.ndim) if a not in axes)
+        marginal = np.sum(self.probabilities(tensor), axis=others)
+        order = list(range(lead)) + [lead + sorted(axes).index(a) for a in axes]
+        marginal = marginal.transpose(order).reshape(self.state.shape[:-1] + (-1,))
+        return tensor, axes, marginal
+
+    def choose(self, probs):
+        """
+        Sample an index from the distribution probs (one index per batch entry)
+        """
+        cum_probs = np.cumsum(probs, axis=-1)
+        if self.batch is None:
+            r = self.rng.random() * cum_probs[-1]
+            return min(np.searchsorted(cum_probs, r, side="right"), len(cum_probs) - 1)
+        r = self.rng.random(self.batch) * cum_probs[:, -1]
+        return np.minimum(np.sum(cum_probs <= r[:, None], axis=-1), cum_probs.shape[-1] - 1)
+
+    def empty_state(self):
+        return np.ones(1, self.dtype) if self.batch is None else np.ones((self.batch, 1), self.dtype)
+
+    def cast(self, values):
+        # gate parameters in the precision of the state
+        values = np.asarray(values)
+        if np.iscomplexobj(values) and self.dtype.kind != "c":
+            raise ValueError(f"complex gate on a {self.dtype} state")
+        return values.astype(self.dtype, copy=False)
+
+    def probabilities(self, amplitudes):
+        # |amplitude|^2, real and in the precision of the state
+        if self.dtype.kind != "c":
+            return amplitudes * amplitudes
+        return amplitudes.real * amplitudes.real + amplitudes.imag * amplitudes.imag
+
+    def outcome_to_basic_states(self, outcome, n):
+        if self.batch is None:
+            return self.index_to_basic_state(outcome, n)
+        return [self.index_to_basic_state(i, n) for i in outcome]
+
+    def index_to_basic_state(self, index, n=None):
+        if n is None:
+            n = len(self.qubits)
+        return format(index, "b").zfill(n) if n > 0 else ""
     
     def basic_state_to_index(self, basic):
         index = 0
@@ -188,77 +331,86 @@ class QuantumComputer:
         return index
 
         
-    def parse(self, a, args, cargs):
-        a = a.strip()
-        if a in cargs:
-            return args[cargs.index(a)]
-        return a
-
-    def ccmd_to_qcmd(self, ccmd, args, cargs):
-        w, code = ccmd.split(":=")
-        w = w.strip()
-        if "AND" in code:
-            a, b = code.split("AND")
-            a, b = self.parse(a, args, cargs), self.parse(b, args, cargs)
-            self.if_A_and_B_then_toggle_C(a, b, w)
-        elif "NOT" in code:
-            a = code.split("NOT")[1].strip()
-            a = self.parse(a, args, cargs)
-            self.if_not_A_then_toggle_B(a, w)
-        elif "OR" in code:
-            a, b = code.split("OR")
-            a, b = self.parse(a, args, cargs), self.parse(b, args, cargs)
-            self.if_A_or_B_then_toggle_C(a, b, w)
-        else:
-            a = self.parse(code.strip(), args, cargs)
-            self.if_A_then_toggle_B(a, w)
-
     def toggle_f_onto_Cs(self, ccode, *args):
-        name, cargs, retvals, ancillas, lines = ccode.get_parsed()
-        assert len(args) == len(cargs) + len(retvals)
-
-        self.new_qubit(*ancillas)
-        
-        for line in lines:
-            self.ccmd_to_qcmd(line, args, cargs)
-
-        for i in range(len(retvals)):
-            rval = retvals[i]
-            self.if_A_then_toggle_B(rval, args[len(cargs) + i])
-        
-        for i in range(len(lines)-1, -1, -1):
-            self.ccmd_to_qcmd(lines[i], args, cargs)
-        
-        self.extract(*ancillas)
+        # toggle each C directly from f's truth table, no ancillas or gate expansion
+        table = ccode.truth_table()
+        n = len(ccode.args)
+        assert len(args) == n + table.shape[-1]
+        for j, C in enumerate(args[n:]):
+            self.toggle_where(C, args[:n], table[..., j])
     
     def if_f_then_toggle_C(self, ccode, *args):
         self.toggle_f_onto_Cs(ccode, *args)
 
     def if_f_then_minus(self, ccode, *args):
-        self.new_qubit('new')
-        self.toggle("new")
-        self.hadamard("new")
-        self.if_f_then_toggle_C(ccode, *args, "new")
-        self.hadamard("new")
-        self.toggle("new")
-        self.extract("new")
+        # (-1)^f(x) as a single sign vector
+        self.apply_phase(ccode.signs(), args)
 
     def if_perp_then_minus(self, U, U_undo, *args):
+        """
+        -1 on the states perpendicular to U|0...0>. When U is hadamard on every qubit
+        this is the closed form 2|s><s| - I, otherwise undo U, -1 on every basis state
+        of args but |0...0>, then U
+        """
+        if U == U_undo == self.hadamard and set(args) == set(self.qubits):
+            self.reflect_uniform(args)
+            return
         U_undo()
-        or4 = CCode("or4")
-        self.if_f_then_minus(or4, *args)
+        mask = np.ones((2,) * len(args), bool)
+        mask[(0,) * len(args)] = False
+        self.apply_phase(mask, args)
         U()
 
+    def reflect_uniform(self, qubits):
+        """
+        2|s><s| - I on qubits, |s> being their uniform superposition: each amplitude
+        becomes twice the mean over qubits minus itself
+        """
+        self.flush() # not a gate the circuit optimizer knows, run what was recorded first
+        tensor, axes = self.tensor(*qubits)
+        mean = np.mean(tensor, axis=tuple(axes), keepdims=True)
+        mean *= 2
+        np.subtract(mean, tensor, out=tensor)
+
     def if_A_then_minus(self, A):
-        new_state = np.zeros_like(self.state)
-        i = self.qubits.index(A)
-        for j in range(len(self.state)):
-            basic = self.index_to_basic_state(j)
-            if basic[i] == "1":
-                new_state[j] = -self.state[j]
-            else:
-                new_state[j] = self.state[j]
-        self.state = new_state
+        self.multi_controlled_Z(A)
+
+    def controlled_Z(self, A, B):
+        self.multi_controlled_Z(A, B)
+
+    def multi_controlled_Z(self, *qubits):
+        """
+        Negate the amplitudes where all qubits are 1, touching only those
+        """
+        if self.circuit is not None:
+            phases = np.ones((2,) * len(qubits))
+            phases[(1,) * len(qubits)] = -1
+            self.diagonal_op(qubits, phases)
+            return
+        tensor, axes = self.tensor(*qubits)
+        index = [slice(None)] * tensor.ndim
+        for axis in axes:
+            index[axis] = 1
+        ones = tensor[tuple(index) + (Ellipsis,)]
+        np.negative(ones, out=ones)
+
+    def apply_phase(self, values, qubits=None):
+        """
+        Multiply the amplitudes by values indexed by the bits of qubits (all qubits by
+        default): 2^k phases, or a boolean mask that is -1 where True
+        """
+        if qubits is None:
+            qubits = self.qubits
+        values = np.asarray(values)
+        if values.dtype == bool:
+            values = np.where(values, -1, 1)
+        self.diagonal_op(qubits, values.reshape((2,) * len(qubits)))
+
+    def phase(self, qubit, angle):
+        # multiply the amplitudes where qubit is 1 by e^(i angle), angle in degrees like rotate
+        cos = np.cos(angle / 180 * np.pi)
+        sin = np.sin(angle / 180 * np.pi)
+        self.diagonal_op([qubit], np.array([1, cos if np.isclose(sin, 0) else cos + 1j * sin]))
 
 
 class CCode:
@@ -268,21 +420,72 @@ class CCode:
     """
     def __init__(self, file_name) -> None:
         self.file_name = file_name
-        self.parse_ccode()
+        # parsed and compiled once per version of the file, see parse_cache
+        (self.name, self.args, self.retvals, self.ancillas, self.lines,
+         self.table) = parse_cache.load(file_name + ".ccode", self.compile)
+        self.sign_table = None
 
-    def parse_ccode(self):
+    def compile(self, path):
+        self.parse_ccode(path)
+        self.table = None
+        self.truth_table()
+        return self.name, self.args, self.retvals, self.ancillas, self.lines, self.table
+
+    def parse_ccode(self, path):
         lines = []
-        with open(self.file_name + ".ccode", 'r') as file:
+        with open(path, 'r') as file:
             for line in file:
                 lines.append(line)
         header, footer = lines[0], lines[-1]
         self.name, args = header.split("(")
         args = args.split(")")[0].split(',')
         self.args = [a.strip() for a in args]
-        self.retvals = footer.split("return")[1].strip().split(',')
+        self.retvals = [r.strip() for r in footer.split("return")[1].split(',')]
         self.lines = lines[1:-1]
         self.ancillas = set(map(lambda x: x.split(":=")[0].strip(), self.lines))
 
     def get_parsed(self):
         return self.name, self.args, self.retvals, self.ancillas, self.lines
 
+    def evaluate(self, inputs):
+        """
+        Run f on arrays of bits, inputs[i] holding values of the i-th argument.
+        Returns one array per return value
+        """
+        values = dict(zip(self.args, inputs))
+        for line in self.lines:
+            w, code = line.split(":=")
+            if "AND" in code:
+                a, b = code.split("AND")
+                value = values[a.strip()] & values[b.strip()]
+            elif "NOT" in code:
+                value = ~values[code.split("NOT")[1].strip()]
+            elif "OR" in code:
+                a, b = code.split("OR")
+                value = values[a.strip()] | values[b.strip()]
+            else:
+                value = values[code.strip()]
+            # each line toggles w, which starts at 0
+            w = w.strip()
+            values[w] = values[w] ^ value if w in values else value
+        return [values[r] for r in self.retvals]
+
+    def signs(self):
+        """
+        (-1)^f on every input for a single return value f, the phases of if_f_then_minus
+        """
+        if self.sign_table is None:
+            self.sign_table = np.where(self.truth_table()[..., 0], -1, 1)
+        return self.sign_table
+
+    def truth_table(self):
+        """
+        f on every input, shape (2, ..., 2, m) indexed by the argument bits
+        """
+        if self.table is None:
+            n = len(self.args)
+            index = np.arange(2**n)
+            inputs = [(index >> (n - 1 - i)) & 1 == 1 for i in range(n)]
+            self.table = np.stack(self.evaluate(inputs), -1).reshape((2,) * n + (len(self.retvals),))
+        return self.table
+
@@ -0,0 +1,35 @@
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from quantum_computer import QuantumComputer
+
+# shots per task. Seeds are given to tasks, not workers, so the merged histogram for
+# a seed is the same whatever the number of workers
+TASK_SHOTS = 1000
+
+def farm(task, shots, workers=None, seed=None):
+    """
+    Split shots into tasks, run task(shots, seed) for each on a pool of worker processes
+    and merge the Counters they return.
+    - task: picklable function (module level, or a functools.partial of one)
+    - workers: number of processes, one per core by default; 1 runs in this process
+    - seed: root of the per-task np.random.SeedSequence streams
+    """
+    sizes = [TASK_SHOTS] * (shots // TASK_SHOTS)
+    if shots % TASK_SHOTS > 0:
+        sizes.append(shots % TASK_SHOTS)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if workers == 1:
+        results = map(task, sizes, seeds)
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(task, sizes, seeds))
+    return sum(results, Counter())
+
+def run_experiment(experiment, trials, seed):
+    """
+    Run experiment(q) trials times on a QuantumComputer seeded with seed and count its
+    results. A task for farm, e.g. farm(partial(run_experiment, experiment), trials)
+    """
+    q = QuantumComputer(seed=seed)
+    return Counter(experiment(q) for _ in range(trials))